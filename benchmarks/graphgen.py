@@ -0,0 +1,128 @@
+"""Synthetic social graphs for benchmarks."""
+
+import random
+from uuid import UUID
+
+from bson import ObjectId
+from werkzeug.security import generate_password_hash
+
+from netwerker.utils.misc import friendship_document
+
+PASSWORD = "benchmark"
+
+
+def barabasi_albert_edges(n: int, m: int, seed: int = None):
+    """
+    Edges of a Barabási–Albert preferential attachment graph.
+
+    Each new node links to ``m`` distinct existing nodes picked with
+    probability proportional to their degree, giving the power-law degree
+    distribution of real social graphs.
+
+    Parameters
+    ----------
+    n : int
+        Number of nodes
+    m : int
+        Edges added per new node
+    seed : int (optional)
+        Random seed, so runs are reproducible
+
+    Returns
+    -------
+    edges : list of tuple
+        (node, node) pairs with node in range(n)
+    """
+    rng = random.Random(seed)
+    edges = []
+
+    # every node appears here once per edge end, so sampling from it is
+    # sampling proportional to degree
+    ends = []
+    for node in range(min(m + 1, n)):
+        for other in range(node):
+            edges.append((other, node))
+            ends.extend((other, node))
+
+    for node in range(m + 1, n):
+        targets = set()
+        while len(targets) < m:
+            targets.add(rng.choice(ends))
+        for target in targets:
+            edges.append((target, node))
+            ends.extend((target, node))
+
+    return edges
+
+
+def load_graph(
+    db,
+    n: int = 10_000,
+    m: int = 3,
+    seed: int = 42,
+    batch_size=5000,
+    storage: str = "array",
+    bucket_size: int = 500,
+):
+    """
+    Replace the users, friends and friend_buckets collections with a graph.
+
+    Documents have the same shape NewUser.post and UserFriends.post write.
+    Every user's password is ``PASSWORD``. Friend lists are written in the
+    layouts the FRIEND_STORAGE value ``storage`` reads and writes, see
+    :mod:`netwerker.utils.adjacency`.
+
+    Returns
+    -------
+    users : list of dict
+        uuid and email of every generated user, in node order
+    """
+    db.users.delete_many({})
+    db.friends.delete_many({})
+    db.friend_buckets.delete_many({})
+
+    rng = random.Random(seed)
+    password_hash = generate_password_hash(PASSWORD)
+    ids = [ObjectId() for _ in range(n)]
+    friends = [[] for _ in range(n)]
+    edges = barabasi_albert_edges(n, m, seed)
+    for a, b in edges:
+        friends[a].append(ids[b])
+        friends[b].append(ids[a])
+
+    users = [
+        {
+            "_id": ids[i],
+            "uuid": str(UUID(int=rng.getrandbits(128), version=4)),
+            "name": f"User{i}",
+            "email": f"user{i}@example.com",
+            "passwordHash": password_hash,
+            "email_verified": True,
+        }
+        for i in range(n)
+    ]
+    if storage in ("array", "dual"):
+        for i, user in enumerate(users):
+            user["friends"] = friends[i]
+    for start in range(0, n, batch_size):
+        db.users.insert_many(users[start : start + batch_size], ordered=False)
+
+    if storage in ("dual", "buckets"):
+        buckets = [
+            {"user_id": ids[i], "count": len(chunk), "friends": chunk}
+            for i in range(n)
+            for chunk in (
+                friends[i][start : start + bucket_size]
+                for start in range(0, len(friends[i]), bucket_size)
+            )
+        ]
+        for start in range(0, len(buckets), batch_size):
+            db.friend_buckets.insert_many(
+                buckets[start : start + batch_size], ordered=False
+            )
+
+    docs = [friendship_document(ids[a], ids[b]) for a, b in edges]
+    for start in range(0, len(docs), batch_size):
+        db.friends.insert_many(docs[start : start + batch_size], ordered=False)
+
+    return [{"uuid": user["uuid"], "email": user["email"]} for user in users]
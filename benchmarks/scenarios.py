@@ -0,0 +1,79 @@
+"""Benchmark scenarios, each one request against the Flask test client."""
+
+import random
+from base64 import b64encode
+from itertools import count
+
+from benchmarks.graphgen import PASSWORD
+
+
+class Scenario(object):
+    """A named request built from the generated users."""
+
+    name = None
+
+    def __init__(self, users: list, seed: int = 0):
+        self.users = users
+        self.rng = random.Random(seed)
+
+    def request(self, client):
+        raise NotImplementedError
+
+    def random_user(self):
+        return self.rng.choice(self.users)
+
+
+class Distance(Scenario):
+    name = "distance"
+
+    def request(self, client):
+        a, b = self.random_user(), self.random_user()
+        return client.get(f"/users/{a['uuid']}/friends/distance/{b['uuid']}")
+
+
+class FriendList(Scenario):
+    name = "friends"
+
+    def request(self, client):
+        return client.get(f"/users/{self.random_user()['uuid']}/friends?limit=100")
+
+
+class AllUsers(Scenario):
+    name = "users_all"
+
+    def request(self, client):
+        return client.get("/users/all?limit=100")
+
+
+class Login(Scenario):
+    name = "login"
+
+    def request(self, client):
+        credentials = f"{self.random_user()['email']}:{PASSWORD}".encode("utf-8")
+        header = "Basic " + b64encode(credentials).decode("utf-8")
+        return client.post("/users/login", headers={"Authorization": header})
+
+
+class Signup(Scenario):
+    name = "signup"
+
+    def __init__(self, users: list, seed: int = 0):
+        super().__init__(users, seed)
+        self._ids = count()
+
+    def request(self, client):
+        i = next(self._ids)
+        return client.post(
+            "/users",
+            json={
+                "name": f"Signup{i}",
+                "email": f"signup{i}-{self.rng.getrandbits(32)}@example.com",
+                "password": PASSWORD,
+            },
+        )
+
+
+SCENARIOS = {
+    scenario.name: scenario
+    for scenario in (Distance, FriendList, AllUsers, Login, Signup)
+}
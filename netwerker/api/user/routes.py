@@ -1,21 +1,37 @@
-from uuid import uuid4
-
 import jwt
 from flask import current_app, g, request
 from flask_accepts import accepts, responds
 from flask_restx import Namespace, Resource
 from werkzeug.exceptions import BadRequest, Forbidden
-from werkzeug.security import generate_password_hash
 
 from netwerker.api.user.schemas import *
 from netwerker.app import mongo
+from netwerker.utils.adjacency import add_friendships, friend_page, reads_arrays
 from netwerker.utils.auth import basic_auth, token_auth
-from netwerker.utils.misc import bfs_friendship_distance, generate_friendship_hash
-from netwerker.utils.mongo_queries import get_user
+from netwerker.utils.graph import friend_graph
+from netwerker.utils.misc import (
+    SearchBudgetExceeded,
+    bfs_distances,
+    bump_graph_epoch,
+    cached_friendship_distance,
+    friendship_document,
+    generate_friendship_hash,
+    shortest_friendship_paths,
+    stream_documents,
+    user_document,
+)
+from netwerker.utils.mongo_queries import bulk_read, get_user, get_users
+from netwerker.utils.passwords import password_hasher
+from netwerker.utils.recommendations import mark_dirty
+from netwerker.utils.validation import (
+    SEARCH_BUDGETS,
+    validate_batch_size,
+    validate_page_args,
+    validate_search_budgets,
+)
 
 ns = Namespace("users", description="Operations related to clients")
 
-
 @ns.route("/login")
 class Login(Resource):
     @ns.doc(security="password")
@@ -29,7 +45,7 @@ class Login(Resource):
         # generate a token
         token = token_auth.generate_token(user, org)
 
-        return {"user": user, "token": token}, 201
+        return {"user": UserSchema().dump(user), "token": token}, 201
 
 
 # @ns.route("/token-validation")
@@ -64,16 +80,51 @@ class Users(Resource):
 
     # @token_auth.login_required(user_types=("admin",))
     # @responds(schema=AllUsersSchema, api=ns, status_code=200)
+    @ns.param("limit", "max number of users to return")
+    @ns.param("after", "next_cursor returned with the previous page")
+    @ns.param("stream", "stream every user as 'ndjson' or a chunked JSON 'array'")
+    @ns.param("batch_size", "documents fetched per round trip while streaming")
     def get(self):
         # user, org = g.flask_httpauth_user, g.flask_httpauth_org
+        projection = {"friends": 0, "passwordHash": 0}
+
+        stream = request.args.get("stream")
+        if stream:
+            if stream not in ("ndjson", "array"):
+                raise BadRequest("stream must be 'ndjson' or 'array'")
+            batch_size = validate_batch_size(
+                request.args.get("batch_size"),
+                current_app.config["STREAM_BATCH_SIZE"],
+                current_app.config["MAX_STREAM_BATCH_SIZE"],
+            )
+
+            users_cursor = bulk_read("users").find(
+                {}, {**projection, "_id": 0}, batch_size=batch_size
+            )
+            return stream_documents(users_cursor, fmt=stream)
+
+        limit, after = validate_page_args(
+            request.args.get("limit"),
+            request.args.get("after"),
+            current_app.config["DEFAULT_PAGE_SIZE"],
+            current_app.config["MAX_PAGE_SIZE"],
+        )
 
-        users_cursor = mongo.db.users.find(
-            {}, {"friends": 0, "passwordHash": 0, "_id": 0}
+        # keyset pagination on _id
+        query = {"_id": {"$gt": after}} if after else {}
+        users = list(
+            bulk_read("users").find(query, projection).sort("_id", 1).limit(limit)
         )
-        # Convert the cursor into a list
-        users = list(users_cursor)
 
-        payload = {"items": users, "total_items": len(users)}
+        next_cursor = str(users[-1]["_id"]) if len(users) == limit else None
+        for user in users:
+            del user["_id"]
+
+        payload = {
+            "items": users,
+            "total_items": mongo.db.users.estimated_document_count(),
+            "next_cursor": next_cursor,
+        }
 
         return payload
 
@@ -95,18 +146,9 @@ class NewUser(Resource):
         if user:
             raise BadRequest("user already exists")
 
-        # hash the password
-        pword_hash = generate_password_hash(data.get("password"))
-
-        # remove password from data, add password hash
-        del data["password"]
-        data["passwordHash"] = pword_hash
-
-        data["uuid"] = str(uuid4())
-        data["email"] = data["email"].lower()
-        data[
-            "email_verified"
-        ] = True  # TODO: set to False and send email to user to verify email address
+        # hash the password, stored in place of the password itself
+        pword_hash = password_hasher.hash(data.get("password"))
+        data = user_document(data, pword_hash)
 
         user = mongo.db.users.insert_one(data)
 
@@ -124,6 +166,9 @@ class User(Resource):
         data = request.parsed_obj
         mongo.db.users.update_one({"uuid": uuid}, {"$set": data})
 
+        # cached principals for this user are now stale
+        token_auth.invalidate_user(uuid)
+
         return
 
     @responds(schema=UserSchema(), api=ns, status_code=200)
@@ -136,17 +181,29 @@ class User(Resource):
 class UserFriends(Resource):
     """access a single user's friends"""
 
-    @responds(schema=AllUsersSchema, api=ns, status_code=200)
+    @ns.param("limit", "max number of friends to return")
+    @ns.param("after", "next_cursor returned with the previous page")
+    @responds(schema=UserPageSchema, api=ns, status_code=200)
     def get(self, uuid):
-        user = get_user(uuid=uuid, get_friends=True)
-        # iterate through friends and get their details
-        for i, friend_id in enumerate(user.get("friends", [])):
-            friend = get_user(_id=friend_id)
-            user["friends"][i] = friend
+        limit, after = validate_page_args(
+            request.args.get("limit"),
+            request.args.get("after"),
+            current_app.config["DEFAULT_PAGE_SIZE"],
+            current_app.config["MAX_PAGE_SIZE"],
+        )
+
+        user = get_user(uuid=uuid, get_friends=reads_arrays(), bulk=True)
+
+        # keyset pagination over the friend ObjectIds
+        page_ids, total, next_cursor = friend_page([user], limit, after)
+
+        # resolve the whole page with a single query
+        friends = get_users(page_ids)
 
         return {
-            "items": user.get("friends", []),
-            "total_items": len(user.get("friends", [])),
+            "items": friends,
+            "total_items": total,
+            "next_cursor": next_cursor,
         }
 
     @ns.param("friend_uuid", "new friend uuid")
@@ -170,28 +227,23 @@ class UserFriends(Resource):
         if cursor:
             raise BadRequest("Users are already friends")
 
-        # sort the two _ids to ensure the hash is the same regardless of the order
-        sorted_ids = sorted([current_user["_id"], friend["_id"]])
-
-        # Add friend to user's friend list
-        mongo.db.users.update_one(
-            {"_id": current_user["_id"]}, {"$push": {"friends": friend["_id"]}}
-        )
-
-        # Add user to friend's friend list 
-        mongo.db.users.update_one(
-            {"_id": friend["_id"]}, {"$push": {"friends": current_user["_id"]}}
-        )
+        # Add each user to the other's friend list
+        add_friendships([(current_user["_id"], friend["_id"])])
 
         # Add the friendship hash to the friends collection (bi-directional) 
         mongo.db.friends.insert_one(
-            {
-                "friendship_hash": friendship_hash,
-                "user1_id": sorted_ids[0],
-                "user2": sorted_ids[1],
-            }
+            friendship_document(current_user["_id"], friend["_id"])
         )
 
+        # keep the in-memory graph in step with the database
+        friend_graph.add_edge(current_user["_id"], friend["_id"])
+
+        # both neighborhoods changed, queue them for the recommendations job
+        mark_dirty(current_user["_id"], friend["_id"])
+
+        # cached distances in every worker are now stale
+        bump_graph_epoch()
+
     # TODO: configure mongo as a replica set so transactions can be used
     # with mongo.db.client.start_session() as session:
     #     try:
@@ -212,18 +264,152 @@ class UserFriends(Resource):
     #         raise e
 
 
+@ns.route("/<string:uuid>/friends/mutual/<string:other_uuid>")
+class UserMutualFriends(Resource):
+    """friends two users have in common"""
+
+    @ns.param("limit", "max number of friends to return")
+    @ns.param("after", "next_cursor returned with the previous page")
+    @responds(schema=UserPageSchema, api=ns, status_code=200)
+    def get(self, uuid, other_uuid):
+        limit, after = validate_page_args(
+            request.args.get("limit"),
+            request.args.get("after"),
+            current_app.config["DEFAULT_PAGE_SIZE"],
+            current_app.config["MAX_PAGE_SIZE"],
+        )
+
+        # both users in one query, their mutual friends in at most one more
+        projection = {"uuid": 1, "friends": 1} if reads_arrays() else {"uuid": 1}
+        users = {
+            user["uuid"]: user
+            for user in bulk_read("users").find(
+                {"uuid": {"$in": [uuid, other_uuid]}}, projection
+            )
+        }
+        if uuid not in users or other_uuid not in users:
+            raise Forbidden("Invalid User")
+
+        page_ids, total, next_cursor = friend_page(list(users.values()), limit, after)
+
+        return {
+            "items": get_users(page_ids) if page_ids else [],
+            "total_items": total,
+            "next_cursor": next_cursor,
+        }
+
+
+@ns.route("/<string:uuid>/friends/distance")
+class UserDistances(Resource):
+    """get distances from one user to many"""
+
+    @accepts(schema=DistanceBatchSchema, api=ns)
+    @responds(schema=DistancesSchema, api=ns, status_code=200)
+    def post(self, uuid):
+        data = request.parsed_obj
+        targets = data["targets"]
+        if len(targets) > current_app.config["MAX_DISTANCE_TARGETS"]:
+            raise BadRequest("Too many targets")
+
+        budgets = validate_search_budgets(data, current_app.config)
+
+        user = get_user(uuid=uuid)
+
+        # resolve every target with one query
+        target_ids = {
+            target["uuid"]: target["_id"]
+            for target in mongo.db.users.find({"uuid": {"$in": targets}}, {"uuid": 1})
+        }
+
+        distances, exceeded = bfs_distances(
+            user["_id"], target_ids.values(), **budgets
+        )
+
+        items = []
+        for target in targets:
+            item = {"uuid": target, "distance": distances.get(target_ids.get(target))}
+            # unreached targets are only unknown when the search stopped early
+            if item["distance"] is None and exceeded and target in target_ids:
+                item.update(exceeded.known())
+            items.append(item)
+
+        return {"items": items, "total_items": len(items)}
+
+
 @ns.route("/<string:user_uuid>/friends/distance/<string:friend_uuid>")
 class UserDistance(Resource):
     """get distance between two users"""
 
     # @responds(api=ns, status_code=200)
+    @ns.param("max_depth", "give up beyond this many hops")
+    @ns.param("max_nodes", "give up after expanding this many users")
+    @ns.param("deadline_ms", "give up after this many milliseconds")
     def get(self, user_uuid, friend_uuid):
         user = get_user(uuid=user_uuid)
         friend = get_user(uuid=friend_uuid)
 
-        # find the distance between the two users
-        distance = bfs_friendship_distance(
-            start_user_id=str(user["_id"]), target_user_id=str(friend["_id"])
+        budgets = validate_search_budgets(
+            {arg: request.args.get(arg) for arg in SEARCH_BUDGETS},
+            current_app.config,
         )
 
+        # find the distance between the two users
+        try:
+            distance = cached_friendship_distance(
+                start_user_id=str(user["_id"]),
+                target_user_id=str(friend["_id"]),
+                **budgets,
+            )
+        except SearchBudgetExceeded as e:
+            return {"distance": None, **e.known()}
+
         return {"distance": distance}
+
+
+@ns.route("/<string:uuid>/recommendations")
+class UserRecommendations(Resource):
+    """people a user may know, ranked by mutual friends"""
+
+    @responds(schema=RecommendationsSchema, api=ns, status_code=200)
+    def get(self, uuid):
+        # precomputed by `flask recommendations refresh`
+        doc = mongo.db.recommendations.find_one({"_id": uuid})
+        candidates = doc["candidates"] if doc else []
+
+        return {"items": candidates, "total_items": len(candidates)}
+
+
+@ns.route("/<string:uuid>/friends/path/<string:other_uuid>")
+class UserPath(Resource):
+    """how two users are connected"""
+
+    @ns.param("k", "max number of shortest paths to return")
+    @ns.param("max_depth", "give up beyond this many hops")
+    @ns.param("max_nodes", "give up after expanding this many users")
+    @ns.param("deadline_ms", "give up after this many milliseconds")
+    @responds(schema=FriendshipPathsSchema, api=ns, status_code=200)
+    def get(self, uuid, other_uuid):
+        k = request.args.get("k", 1, type=int)
+        max_paths = current_app.config["MAX_PATHS"]
+        if not 1 <= k <= max_paths:
+            raise BadRequest(f"k must be between 1 and {max_paths}")
+        budgets = validate_search_budgets(
+            {arg: request.args.get(arg) for arg in SEARCH_BUDGETS},
+            current_app.config,
+        )
+
+        user = get_user(uuid=uuid)
+        other = get_user(uuid=other_uuid)
+
+        try:
+            paths = shortest_friendship_paths(user["_id"], other["_id"], k, **budgets)
+        except SearchBudgetExceeded as e:
+            return {"distance": None, "paths": [], **e.known()}
+
+        # hydrate every user on every path with one query
+        users = {u["_id"]: u for u in get_users({_id for p in paths for _id in p})}
+
+        return {
+            "distance": len(paths[0]) - 1 if paths else None,
+            "paths": [[users[_id] for _id in path if _id in users] for path in paths],
+        }
@@ -26,3 +26,46 @@ class UserPatchSchema(Schema):
 class AllUsersSchema(Schema):
     items = fields.Nested(UserSchema(many=True))
     total_items = fields.Integer()
+
+
+class UserPageSchema(AllUsersSchema):
+    next_cursor = fields.String(allow_none=True)
+
+
+class RecommendationSchema(Schema):
+    uuid = fields.UUID()
+    name = fields.String()
+    mutual_friends = fields.Integer()
+
+
+class RecommendationsSchema(Schema):
+    items = fields.Nested(RecommendationSchema(many=True))
+    total_items = fields.Integer()
+
+
+class DistanceBatchSchema(Schema):
+    targets = fields.List(
+        fields.String(), required=True, validate=validate.Length(min=1)
+    )
+    max_depth = fields.Integer(validate=validate.Range(min=1))
+    max_nodes = fields.Integer(validate=validate.Range(min=1))
+    deadline_ms = fields.Integer(validate=validate.Range(min=1))
+
+
+class TargetDistanceSchema(Schema):
+    uuid = fields.String()
+    distance = fields.Integer(allow_none=True)
+    farther_than = fields.Integer()
+    unknown = fields.Boolean()
+
+
+class DistancesSchema(Schema):
+    items = fields.Nested(TargetDistanceSchema(many=True))
+    total_items = fields.Integer()
+
+
+class FriendshipPathsSchema(Schema):
+    distance = fields.Integer(allow_none=True)
+    farther_than = fields.Integer()
+    unknown = fields.Boolean()
+    paths = fields.List(fields.Nested(UserSchema(many=True)))
@@ -5,6 +5,7 @@ from flask import Flask
 from flask_cors import CORS
 from flask_marshmallow import Marshmallow
 from flask_pymongo import PyMongo
+from pymongo.errors import PyMongoError
 
 from netwerker.config import Config
 
@@ -43,10 +44,76 @@ def create_app():
 
     cors.init_app(app)
     ma.init_app(app)
-    mongo.init_app(app)
+
+    from netwerker.utils.metrics import metrics
+
+    metrics.init_app(app)
+    client_options = {
+        "maxPoolSize": app.config["MONGO_MAX_POOL_SIZE"],
+        "minPoolSize": app.config["MONGO_MIN_POOL_SIZE"],
+        "waitQueueTimeoutMS": app.config["MONGO_WAIT_QUEUE_TIMEOUT_MS"],
+        "serverSelectionTimeoutMS": app.config["MONGO_SERVER_SELECTION_TIMEOUT_MS"],
+        "readPreference": app.config["MONGO_READ_PREFERENCE"],
+    }
+    if app.config["MONGO_COMPRESSORS"]:
+        client_options["compressors"] = app.config["MONGO_COMPRESSORS"]
+
+    mongo.init_app(
+        app,
+        event_listeners=[metrics.listener, metrics.pool_listener],
+        **client_options,
+    )
+
+    from netwerker.utils.graph import friend_graph
+
+    friend_graph.init_app(app)
+
+    from netwerker.utils.misc import distance_cache
+
+    distance_cache.maxsize = app.config["DISTANCE_CACHE_SIZE"]
+    distance_cache.ttl = app.config["DISTANCE_CACHE_TTL"]
+
+    from netwerker.utils.auth import token_auth
+
+    token_auth.init_app(app)
+
+    from netwerker.utils.passwords import password_hasher
+
+    password_hasher.init_app(app)
+
+    from netwerker.utils.email_dispatch import email_dispatcher
+
+    email_dispatcher.init_app(app)
+
+    from netwerker.utils.graph_sync import graph_sync
+
+    graph_sync.init_app(app)
+
+    if app.config["SYNC_INDEXES"]:
+        from netwerker.utils.indexes import sync_indexes
+
+        try:
+            sync_indexes()
+        except PyMongoError as e:
+            # serve anyway, as without SYNC_INDEXES
+            logger.error(f"Index sync skipped, Mongo unavailable: {e}")
 
     from netwerker.api import api, bp
 
     app.register_blueprint(bp)
 
+    from netwerker.cli import (
+        db_cli,
+        email_cli,
+        friends_cli,
+        recommendations_cli,
+        users_cli,
+    )
+
+    app.cli.add_command(db_cli)
+    app.cli.add_command(email_cli)
+    app.cli.add_command(friends_cli)
+    app.cli.add_command(recommendations_cli)
+    app.cli.add_command(users_cli)
+
     return app
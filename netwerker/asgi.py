@@ -0,0 +1,405 @@
+"""
+Async serving mode for the read heavy ``users`` routes.
+
+The graph and friends endpoints spend nearly all of their time waiting on
+Mongo, so here they run on asyncio (Quart) with the Motor driver: one process
+keeps thousands of requests in flight and independent lookups are issued
+concurrently. Routes and responses match the sync ``users`` namespace.
+Writes (signup, login, adding friends) stay on the sync deployment, which is
+still built by :func:`netwerker.app.create_app`.
+
+    pip install netwerker[async]
+    hypercorn "netwerker.asgi:create_asgi_app()"
+"""
+
+import asyncio
+import time
+
+from marshmallow import ValidationError
+from motor.motor_asyncio import AsyncIOMotorClient
+from quart import Blueprint, Quart, Response, current_app, request, stream_with_context
+from quart.json import dumps
+from werkzeug.exceptions import BadRequest, Forbidden, HTTPException
+
+from netwerker.api.user.schemas import (
+    DistanceBatchSchema,
+    DistancesSchema,
+    FriendshipPathsSchema,
+    RecommendationsSchema,
+    UserPageSchema,
+    UserSchema,
+)
+from netwerker.app import conf, logger
+from netwerker.utils.adjacency import (
+    array_page,
+    bucket_page_pipeline,
+    bucket_page_result,
+)
+from netwerker.utils.misc import (
+    SearchBudgetExceeded,
+    bidirectional_distance_search,
+    bidirectional_paths_search,
+    distance_cache,
+    generate_friendship_hash,
+    level_distance_search,
+    within_depth,
+)
+from netwerker.utils.mongo_queries import READ_PREFERENCES, USER_SUMMARY_PROJECTION
+from netwerker.utils.validation import (
+    SEARCH_BUDGETS,
+    validate_batch_size,
+    validate_page_args,
+    validate_search_budgets,
+)
+
+
+class AsyncMongo(object):
+    """Motor client created on the serving event loop."""
+
+    def __init__(self):
+        self.cx = None
+        self.db = None
+
+    def init_app(self, app):
+        @app.before_serving
+        async def connect():
+            options = {
+                "maxPoolSize": app.config["MONGO_MAX_POOL_SIZE"],
+                "minPoolSize": app.config["MONGO_MIN_POOL_SIZE"],
+                "waitQueueTimeoutMS": app.config["MONGO_WAIT_QUEUE_TIMEOUT_MS"],
+                "readPreference": app.config["MONGO_READ_PREFERENCE"],
+            }
+            if app.config["MONGO_COMPRESSORS"]:
+                options["compressors"] = app.config["MONGO_COMPRESSORS"]
+            self.cx = AsyncIOMotorClient(app.config["MONGO_URI"], **options)
+            self.db = self.cx.get_default_database()
+
+        @app.after_serving
+        async def disconnect():
+            self.cx.close()
+
+    def bulk_read(self, collection: str):
+        """Async counterpart of :func:`netwerker.utils.mongo_queries.bulk_read`."""
+        mode = READ_PREFERENCES[current_app.config["MONGO_BULK_READ_PREFERENCE"]]
+        return self.db.get_collection(collection, read_preference=mode)
+
+
+async_mongo = AsyncMongo()
+
+bp = Blueprint("users_async", __name__, url_prefix="/users")
+
+
+async def get_user(uuid: str, get_friends: bool = False, bulk: bool = False):
+    proj = {"friends": 0} if not get_friends else {}
+    users = async_mongo.bulk_read("users") if bulk else async_mongo.db.users
+    user = await users.find_one({"uuid": uuid}, projection=proj)
+    if user is None:
+        raise Forbidden("Invalid User")
+    return user
+
+
+async def get_users(_ids):
+    cursor = (
+        async_mongo.bulk_read("users")
+        .find({"_id": {"$in": list(_ids)}}, USER_SUMMARY_PROJECTION)
+        .sort("_id", 1)
+    )
+    return await cursor.to_list(length=None)
+
+
+async def get_friend_lists(_ids, chunk_size: int = 1000, primary: bool = False):
+    """Friend lists for many users, large frontiers fetched in concurrent chunks."""
+    _ids = list(_ids)
+    read = async_mongo.db.get_collection if primary else async_mongo.bulk_read
+    # with bucket storage a user's friends span several documents
+    if current_app.config["FRIEND_STORAGE"] == "buckets":
+        coll, key = read("friend_buckets"), "user_id"
+    else:
+        coll, key = read("users"), "_id"
+
+    async def fetch(chunk):
+        cursor = coll.find({key: {"$in": chunk}}, {key: 1, "friends": 1})
+        return await cursor.sort([(key, 1), ("_id", 1)]).to_list(length=None)
+
+    chunks = await asyncio.gather(
+        *(
+            fetch(_ids[start : start + chunk_size])
+            for start in range(0, len(_ids), chunk_size)
+        )
+    )
+
+    lists = {}
+    for chunk in chunks:
+        for doc in chunk:
+            lists.setdefault(doc[key], []).extend(doc.get("friends", []))
+    return {_id: list(dict.fromkeys(friends)) for _id, friends in lists.items()}
+
+
+def reads_arrays():
+    """Async counterpart of :func:`netwerker.utils.adjacency.reads_arrays`."""
+    return current_app.config["FRIEND_STORAGE"] != "buckets"
+
+
+async def friend_page(users: list, limit: int, after=None):
+    """Async counterpart of :func:`netwerker.utils.adjacency.friend_page`."""
+    if reads_arrays():
+        return array_page(users, limit, after)
+
+    user_ids = list(dict.fromkeys(user["_id"] for user in users))
+    cursor = async_mongo.bulk_read("friend_buckets").aggregate(
+        bucket_page_pipeline(user_ids, limit, after), allowDiskUse=True
+    )
+    results = await cursor.to_list(length=1)
+    return bucket_page_result(results[0], limit)
+
+
+def page_args():
+    return validate_page_args(
+        request.args.get("limit"),
+        request.args.get("after"),
+        current_app.config["DEFAULT_PAGE_SIZE"],
+        current_app.config["MAX_PAGE_SIZE"],
+    )
+
+
+def search_budgets(requested: dict):
+    """Budgets from :func:`validate_search_budgets` as the searches take them."""
+    budgets = validate_search_budgets(requested, current_app.config)
+    return {
+        "max_depth": budgets["max_depth"],
+        "max_nodes": budgets["max_nodes"],
+        "deadline": time.monotonic() + budgets["deadline_ms"] / 1000,
+    }
+
+
+def query_budgets():
+    return search_budgets({arg: request.args.get(arg) for arg in SEARCH_BUDGETS})
+
+
+def stream_documents(cursor, fmt: str = "ndjson"):
+    """Async counterpart of :func:`netwerker.utils.misc.stream_documents`."""
+
+    @stream_with_context
+    async def generate():
+        if fmt == "ndjson":
+            async for doc in cursor:
+                yield (dumps(doc) + "\n").encode()
+            return
+
+        yield b"["
+        separator = b""
+        async for doc in cursor:
+            yield separator + dumps(doc).encode()
+            separator = b","
+        yield b"]"
+
+    mimetype = "application/x-ndjson" if fmt == "ndjson" else "application/json"
+
+    return Response(generate(), mimetype=mimetype)
+
+
+@bp.route("/all")
+async def all_users():
+    projection = {"friends": 0, "passwordHash": 0}
+    users_coll = async_mongo.bulk_read("users")
+
+    stream = request.args.get("stream")
+    if stream:
+        if stream not in ("ndjson", "array"):
+            raise BadRequest("stream must be 'ndjson' or 'array'")
+        batch_size = validate_batch_size(
+            request.args.get("batch_size"),
+            current_app.config["STREAM_BATCH_SIZE"],
+            current_app.config["MAX_STREAM_BATCH_SIZE"],
+        )
+        cursor = users_coll.find({}, {**projection, "_id": 0}, batch_size=batch_size)
+        return stream_documents(cursor, fmt=stream)
+
+    limit, after = page_args()
+    query = {"_id": {"$gt": after}} if after else {}
+
+    users, total = await asyncio.gather(
+        users_coll.find(query, projection)
+        .sort("_id", 1)
+        .limit(limit)
+        .to_list(length=None),
+        users_coll.estimated_document_count(),
+    )
+
+    next_cursor = str(users[-1]["_id"]) if len(users) == limit else None
+    for user in users:
+        del user["_id"]
+
+    return {"items": users, "total_items": total, "next_cursor": next_cursor}
+
+
+@bp.route("/<string:uuid>")
+async def user(uuid):
+    return UserSchema().dump(await get_user(uuid))
+
+
+@bp.route("/<string:uuid>/friends")
+async def user_friends(uuid):
+    limit, after = page_args()
+    user = await get_user(uuid, get_friends=reads_arrays(), bulk=True)
+    page_ids, total, next_cursor = await friend_page([user], limit, after)
+
+    return UserPageSchema().dump(
+        {
+            "items": await get_users(page_ids) if page_ids else [],
+            "total_items": total,
+            "next_cursor": next_cursor,
+        }
+    )
+
+
+@bp.route("/<string:uuid>/friends/mutual/<string:other_uuid>")
+async def user_mutual_friends(uuid, other_uuid):
+    limit, after = page_args()
+    user, other = await asyncio.gather(
+        get_user(uuid, get_friends=reads_arrays(), bulk=True),
+        get_user(other_uuid, get_friends=reads_arrays(), bulk=True),
+    )
+
+    page_ids, total, next_cursor = await friend_page([user, other], limit, after)
+
+    return UserPageSchema().dump(
+        {
+            "items": await get_users(page_ids) if page_ids else [],
+            "total_items": total,
+            "next_cursor": next_cursor,
+        }
+    )
+
+
+async def run_search(search, primary: bool = False):
+    """Drive one of the shared I/O-free searches with async level fetches."""
+    try:
+        frontier = next(search)
+        while True:
+            frontier = search.send(await get_friend_lists(frontier, primary=primary))
+    except StopIteration as done:
+        return done.value
+
+
+@bp.route("/<string:uuid>/friends/distance", methods=["POST"])
+async def user_distances(uuid):
+    try:
+        data = DistanceBatchSchema().load(await request.get_json(force=True))
+    except ValidationError as e:
+        raise BadRequest(e.messages)
+    targets = data["targets"]
+    if len(targets) > current_app.config["MAX_DISTANCE_TARGETS"]:
+        raise BadRequest("Too many targets")
+    budgets = search_budgets(data)
+
+    # resolve every target with one query
+    user, resolved = await asyncio.gather(
+        get_user(uuid),
+        async_mongo.db.users.find({"uuid": {"$in": targets}}, {"uuid": 1}).to_list(
+            length=None
+        ),
+    )
+    target_ids = {target["uuid"]: target["_id"] for target in resolved}
+
+    found, exceeded = await run_search(
+        level_distance_search(user["_id"], set(target_ids.values()), **budgets)
+    )
+
+    items = []
+    for target in targets:
+        item = {"uuid": target, "distance": found.get(target_ids.get(target))}
+        # unreached targets are only unknown when the search stopped early
+        if item["distance"] is None and exceeded and target in target_ids:
+            item.update(exceeded.known())
+        items.append(item)
+
+    return DistancesSchema().dump({"items": items, "total_items": len(items)})
+
+
+@bp.route("/<string:user_uuid>/friends/distance/<string:friend_uuid>")
+async def user_distance(user_uuid, friend_uuid):
+    budgets = query_budgets()
+
+    user, friend, epoch_doc = await asyncio.gather(
+        get_user(user_uuid),
+        get_user(friend_uuid),
+        async_mongo.db.counters.find_one({"_id": "graph_epoch"}),
+    )
+
+    # same cache and epoch as the sync deployment
+    epoch = epoch_doc["value"] if epoch_doc else 0
+    key = (generate_friendship_hash(str(user["_id"]), str(friend["_id"])), epoch)
+    missing = object()
+    distance = distance_cache.get(key, missing)
+    try:
+        if distance is missing:
+            # on the primary like the epoch, see cached_friendship_distance
+            distance = await run_search(
+                bidirectional_distance_search(user["_id"], friend["_id"], **budgets),
+                primary=True,
+            )
+            distance_cache.set(key, distance)
+        distance = within_depth(distance, budgets["max_depth"])
+    except SearchBudgetExceeded as e:
+        return {"distance": None, **e.known()}
+
+    return {"distance": distance}
+
+
+@bp.route("/<string:uuid>/friends/path/<string:other_uuid>")
+async def user_path(uuid, other_uuid):
+    k = request.args.get("k", 1, type=int)
+    max_paths = current_app.config["MAX_PATHS"]
+    if not 1 <= k <= max_paths:
+        raise BadRequest(f"k must be between 1 and {max_paths}")
+    budgets = query_budgets()
+
+    user, other = await asyncio.gather(get_user(uuid), get_user(other_uuid))
+
+    try:
+        paths = await run_search(
+            bidirectional_paths_search(user["_id"], other["_id"], k, **budgets)
+        )
+    except SearchBudgetExceeded as e:
+        return FriendshipPathsSchema().dump(
+            {"distance": None, "paths": [], **e.known()}
+        )
+
+    # hydrate every user on every path with one query
+    users = {u["_id"]: u for u in await get_users({_id for p in paths for _id in p})}
+
+    return FriendshipPathsSchema().dump(
+        {
+            "distance": len(paths[0]) - 1 if paths else None,
+            "paths": [[users[_id] for _id in path if _id in users] for path in paths],
+        }
+    )
+
+
+@bp.route("/<string:uuid>/recommendations")
+async def user_recommendations(uuid):
+    doc = await async_mongo.db.recommendations.find_one({"_id": uuid})
+    candidates = doc["candidates"] if doc else []
+
+    return RecommendationsSchema().dump(
+        {"items": candidates, "total_items": len(candidates)}
+    )
+
+
+async def http_error(e: HTTPException):
+    """Errors as JSON, the way the sync flask-restx API renders them."""
+    return {"message": e.description}, e.code
+
+
+def create_asgi_app():
+    app = Quart(__name__)
+    app.config.from_object(conf)
+
+    async_mongo.init_app(app)
+    app.register_blueprint(bp)
+    app.register_error_handler(HTTPException, http_error)
+
+    logger.info("Async serving mode: read only users routes")
+
+    return app
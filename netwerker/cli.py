@@ -0,0 +1,200 @@
+import csv
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from netwerker.utils import adjacency, bulk, fanout, indexes, recommendations
+from netwerker.utils.graph import friend_graph
+from netwerker.utils.graph_sync import GraphSync, mark_recommendations_dirty
+
+db_cli = AppGroup("db", help="Database maintenance commands.")
+
+
+@db_cli.command("sync-indexes")
+def sync_indexes():
+    """Create the indexes declared in netwerker.utils.indexes."""
+    failures = indexes.sync_indexes()
+    if failures:
+        click.echo(f"Failed to build: {', '.join(failures)}", err=True)
+        raise SystemExit(1)
+    click.echo("Indexes in sync.")
+
+
+@db_cli.command("check-indexes")
+def check_indexes():
+    """Fail if any known query shape falls back to a collection scan."""
+    failures = indexes.check_query_plans()
+    if failures:
+        click.echo(f"COLLSCAN in: {', '.join(failures)}", err=True)
+        raise SystemExit(1)
+    click.echo("All query shapes use an index.")
+
+
+users_cli = AppGroup("users", help="User account commands.")
+
+
+def _read_ndjson(source):
+    for line in source:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            # passed on as is, the schema rejects it as an invalid record
+            yield line
+
+
+@users_cli.command("import")
+@click.argument("source", type=click.File("r"))
+@click.option("--format", "fmt", type=click.Choice(["csv", "ndjson"]), default="csv")
+@click.option("--batch-size", default=1000, show_default=True)
+@click.option(
+    "--workers",
+    default=os.cpu_count(),
+    show_default=True,
+    help="Password hashing processes.",
+)
+@click.option(
+    "--errors",
+    type=click.File("w"),
+    help="Write rejected records here as NDJSON instead of stderr.",
+)
+def import_users(source, fmt, batch_size, workers, errors):
+    """Bulk create users from CSV (name,email,password) or NDJSON ('-' for stdin)."""
+    records = csv.DictReader(source) if fmt == "csv" else _read_ndjson(source)
+
+    def report(number, messages):
+        line = json.dumps({"record": number, "errors": messages})
+        click.echo(line, file=errors, err=True)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        stats = bulk.import_users(
+            records, batch_size=batch_size, executor=executor, on_error=report
+        )
+    click.echo(json.dumps(stats))
+
+
+friends_cli = AppGroup("friends", help="Friendship graph commands.")
+
+
+@friends_cli.command("import")
+@click.argument("source", type=click.File("r"))
+@click.option("--batch-size", default=1000, show_default=True)
+def import_friendships(source, batch_size):
+    """Bulk add friendships from a CSV of uuid pairs ('-' for stdin)."""
+    pairs = (
+        tuple(row[:2])
+        for row in csv.reader(source)
+        if len(row) >= 2 and row[0] != "uuid"  # skip an optional header
+    )
+    stats = bulk.ingest_friendships(pairs, batch_size=batch_size)
+    click.echo(json.dumps(stats))
+
+
+@friends_cli.command("migrate-buckets")
+@click.option("--batch-size", default=1000, show_default=True)
+@click.option(
+    "--drop-arrays",
+    is_flag=True,
+    help="Remove the embedded friends arrays instead, once FRIEND_STORAGE=buckets.",
+)
+def migrate_buckets(batch_size, drop_arrays):
+    """Copy the embedded friends arrays into friend_buckets."""
+    if drop_arrays:
+        try:
+            dropped = adjacency.drop_friend_arrays()
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+        click.echo(f"Dropped the friends array of {dropped} users.")
+        return
+
+    if adjacency.storage() == "array":
+        raise click.ClickException(
+            "Set FRIEND_STORAGE=dual on every worker before migrating"
+        )
+    stats = adjacency.migrate_to_buckets(batch_size=batch_size)
+    click.echo(json.dumps(stats))
+
+
+@friends_cli.command("snapshot")
+@click.option("--path", help="Snapshot file, GRAPH_SNAPSHOT_PATH by default.")
+def snapshot(path):
+    """Write the friend graph to a binary snapshot for fast worker start."""
+    path = path or current_app.config["GRAPH_SNAPSHOT_PATH"]
+    if not path:
+        raise click.ClickException("Pass --path or set GRAPH_SNAPSHOT_PATH")
+
+    # taken before reading, friendships added meanwhile are replayed on load
+    created_at = datetime.utcnow()
+    friend_graph.load()
+    friend_graph.save_snapshot(path, created_at)
+    click.echo(json.dumps(friend_graph.memory_usage()))
+
+
+@friends_cli.command("sync")
+@click.option(
+    "--name",
+    default="recommendations",
+    show_default=True,
+    help="Key under which the stream position is saved.",
+)
+def sync(name):
+    """Follow friendship changes and queue recommendation refreshes."""
+    graph_sync = GraphSync(name)
+    graph_sync.configure(current_app.config)
+    graph_sync.register(mark_recommendations_dirty)
+    click.echo(f"Following friendship changes as {name}, Ctrl-C to stop.")
+    try:
+        graph_sync.run()
+    except KeyboardInterrupt:
+        pass
+    click.echo(json.dumps(graph_sync.stats))
+
+
+email_cli = AppGroup("email", help="Email commands.")
+
+
+@email_cli.command("fanout")
+@click.argument("template")
+@click.option("--segment", type=click.Choice(["all", "friends"]), default="all")
+@click.option("--uuid", help="User whose friends to email for --segment friends.")
+@click.option("--body", default="", help="Value for email_body in the template.")
+@click.option("--rate", default=14.0, show_default=True, help="Messages per second.")
+@click.option("--chunk-size", default=50, show_default=True)
+def fan_out_email(template, segment, uuid, body, rate, chunk_size):
+    """Send TEMPLATE to every user in a segment."""
+    recipients = fanout.segment_recipients(segment, uuid=uuid)
+    stats = fanout.fan_out(
+        template,
+        recipients,
+        context={"email_body": body},
+        chunk_size=chunk_size,
+        rate=rate,
+    )
+    click.echo(json.dumps(stats))
+
+
+recommendations_cli = AppGroup(
+    "recommendations", help="People you may know precomputation."
+)
+
+
+@recommendations_cli.command("refresh")
+@click.option("--all", "refresh_all", is_flag=True, help="Refresh every user.")
+@click.option("--top-k", default=None, type=int, help="Candidates kept per user.")
+@click.option("--batch-size", default=500, show_default=True)
+@click.option("--workers", default=4, show_default=True)
+def refresh_recommendations(refresh_all, top_k, batch_size, workers):
+    """Recompute recommendations for users whose friendships changed."""
+    top_k = top_k or current_app.config["RECOMMENDATIONS_TOP_K"]
+    kwargs = {"k": top_k, "batch_size": batch_size, "workers": workers}
+    if refresh_all:
+        refreshed = recommendations.refresh_all(**kwargs)
+    else:
+        refreshed = recommendations.refresh_dirty(**kwargs)
+    click.echo(f"Refreshed {refreshed} users.")
@@ -0,0 +1,286 @@
+"""
+Friend list storage.
+
+Friendships have historically been an embedded ``friends`` array on each user
+document, which grows without bound and is rewritten on every add. The
+bucketed layout keeps them in the ``friend_buckets`` collection instead, as
+fixed-size chunks per user:
+
+    {"_id": ObjectId, "user_id": ObjectId, "count": int, "friends": [ObjectId]}
+
+A new friend is pushed onto any bucket of the user with room left, so a write
+touches one small document no matter the user's degree.
+
+FRIEND_STORAGE selects the layout and drives the online migration:
+
+    "array"    read and write the embedded arrays (the original layout)
+    "dual"     write both, read the arrays; run ``flask friends migrate-buckets``
+    "buckets"  read and write buckets only; arrays may then be dropped
+"""
+
+from flask import current_app
+from pymongo import UpdateOne
+
+from netwerker.app import logger, mongo
+from netwerker.utils.mongo_queries import bulk_read
+
+
+def storage():
+    return current_app.config.get("FRIEND_STORAGE", "array")
+
+
+def reads_arrays():
+    """
+    Whether friends are read from the embedded arrays.
+
+    Only then must user lookups feeding :func:`friend_page` or
+    :func:`friend_lists_of` project the ``friends`` field.
+    """
+    return storage() != "buckets"
+
+
+def add_friendships(pairs):
+    """
+    Record new friendships in both users' friend lists.
+
+    Safe to repeat for a pair: arrays add each friend once, and a friend
+    stored twice in buckets is deduplicated when read.
+
+    Parameters
+    ----------
+    pairs : list of tuple
+        (ObjectId, ObjectId) pairs, each added in both directions
+    """
+    mode = storage()
+    directed = [(a, b) for a, b in pairs] + [(b, a) for a, b in pairs]
+    if not directed:
+        return
+
+    if mode in ("array", "dual"):
+        mongo.db.users.bulk_write(
+            [UpdateOne({"_id": a}, {"$addToSet": {"friends": b}}) for a, b in directed],
+            ordered=False,
+        )
+
+    if mode in ("dual", "buckets"):
+        size = current_app.config["FRIEND_BUCKET_SIZE"]
+        # ordered so two adds for one user cannot both open a new bucket
+        mongo.db.friend_buckets.bulk_write(
+            [
+                UpdateOne(
+                    {"user_id": a, "count": {"$lt": size}},
+                    {"$push": {"friends": b}, "$inc": {"count": 1}},
+                    upsert=True,
+                )
+                for a, b in directed
+            ],
+            ordered=True,
+        )
+
+
+def _collection(name: str, primary: bool):
+    return mongo.db[name] if primary else bulk_read(name)
+
+
+def _bucket_friend_lists(user_ids, primary: bool = False):
+    lists = {}
+    cursor = (
+        _collection("friend_buckets", primary)
+        .find({"user_id": {"$in": list(user_ids)}}, {"user_id": 1, "friends": 1})
+        .sort([("user_id", 1), ("_id", 1)])
+    )
+    for bucket in cursor:
+        lists.setdefault(bucket["user_id"], []).extend(bucket["friends"])
+
+    # the migration can race a dual write into a duplicate entry
+    return {user_id: list(dict.fromkeys(friends)) for user_id, friends in lists.items()}
+
+
+def get_friend_lists(user_ids, primary: bool = False):
+    """
+    Friend lists for many users with a single query.
+
+    Parameters
+    ----------
+    user_ids : iterable of ObjectId
+        User ObjectIds whose friends should be fetched
+    primary : bool
+        Read from the primary instead of following the bulk read preference,
+        for results that must not lag behind the graph epoch
+
+    Returns
+    -------
+    friend_lists : dict
+        Maps each user ObjectId with friends to its list of friend ObjectIds
+    """
+    if storage() == "buckets":
+        return _bucket_friend_lists(user_ids, primary)
+
+    cursor = _collection("users", primary).find(
+        {"_id": {"$in": list(user_ids)}}, {"friends": 1}
+    )
+    return {user["_id"]: user.get("friends", []) for user in cursor}
+
+
+def friend_lists_of(users: list):
+    """
+    Friend lists for user documents already fetched with their friends array.
+
+    Only bucket storage needs another query, and then one for all of them.
+    """
+    if storage() == "buckets":
+        return _bucket_friend_lists(user["_id"] for user in users)
+    return {user["_id"]: user.get("friends", []) for user in users}
+
+
+def get_friend_ids(user: dict):
+    """Friends of one user document fetched with get_user(get_friends=True)."""
+    return friend_lists_of([user]).get(user["_id"], [])
+
+
+def bucket_page_pipeline(user_ids: list, limit: int, after=None):
+    """
+    Aggregation cutting one page of the friends shared by all of ``user_ids``.
+
+    The buckets are unwound, deduplicated and sorted on the server and only
+    the page and the total come back, so the transfer does not grow with the
+    users' degree. Pages follow friend ObjectId order like the arrays do.
+    """
+    page = [{"$match": {"_id": {"$gt": after}}}] if after else []
+    return [
+        {"$match": {"user_id": {"$in": user_ids}}},
+        {"$unwind": "$friends"},
+        # also drops a duplicate left by the migration racing a dual write
+        {"$group": {"_id": "$friends", "owners": {"$addToSet": "$user_id"}}},
+        {"$match": {f"owners.{len(user_ids) - 1}": {"$exists": True}}},
+        {"$sort": {"_id": 1}},
+        {
+            "$facet": {
+                "page": page + [{"$limit": limit + 1}, {"$project": {"_id": 1}}],
+                "total": [{"$count": "count"}],
+            }
+        },
+    ]
+
+
+def bucket_page_result(result: dict, limit: int):
+    """Page tuple, as returned by :func:`friend_page`, of the pipeline's output."""
+    ids = [doc["_id"] for doc in result["page"]]
+    total = result["total"][0]["count"] if result["total"] else 0
+    next_cursor = str(ids[limit - 1]) if len(ids) > limit else None
+    return ids[:limit], total, next_cursor
+
+
+def array_page(users: list, limit: int, after=None):
+    """:func:`friend_page` for user documents holding their friends arrays."""
+    # misc reads friend lists through this module
+    from netwerker.utils.misc import mutual_friends, paginate_ids
+
+    lists = [user.get("friends", []) for user in users]
+    ids = sorted(lists[0]) if len(lists) == 1 else mutual_friends(*lists)
+    page_ids, next_cursor = paginate_ids(ids, limit, after)
+    return page_ids, len(ids), next_cursor
+
+
+def friend_page(users: list, limit: int, after=None):
+    """
+    One keyset page of the friends shared by every user, in ObjectId order.
+
+    Parameters
+    ----------
+    users : list of dict
+        One user document for its friends, two for their mutual friends,
+        fetched with their friends arrays
+    limit : int
+        Page size
+    after : ObjectId (optional)
+        Cursor returned with the previous page
+
+    Returns
+    -------
+    page : tuple
+        The friend ids on this page, the total number of friends and the
+        cursor for the next page (None on the last)
+    """
+    if reads_arrays():
+        return array_page(users, limit, after)
+
+    user_ids = list(dict.fromkeys(user["_id"] for user in users))
+    cursor = bulk_read("friend_buckets").aggregate(
+        bucket_page_pipeline(user_ids, limit, after), allowDiskUse=True
+    )
+    return bucket_page_result(next(cursor), limit)
+
+
+def iter_adjacency(batch_size: int = 10_000):
+    """
+    Stream (user ObjectId, friends) for the whole graph.
+
+    With bucket storage a user appears once per bucket.
+    """
+    if storage() == "buckets":
+        cursor = bulk_read("friend_buckets").find(
+            {}, {"user_id": 1, "friends": 1}, batch_size=batch_size
+        )
+        for bucket in cursor:
+            yield bucket["user_id"], bucket["friends"]
+    else:
+        cursor = bulk_read("users").find({}, {"friends": 1}, batch_size=batch_size)
+        for user in cursor:
+            yield user["_id"], user.get("friends") or []
+
+
+def migrate_to_buckets(batch_size: int = 1000):
+    """
+    Copy the embedded friends arrays into buckets.
+
+    Safe to run while the app serves traffic in "dual" mode and to re-run:
+    only friends missing from a user's buckets are copied, and writes that
+    happen meanwhile land in both layouts.
+
+    Returns
+    -------
+    stats : dict
+        Users scanned and friend entries copied
+    """
+    # bulk writes friends through this module
+    from netwerker.utils.bulk import batched
+
+    size = current_app.config["FRIEND_BUCKET_SIZE"]
+    stats = {"users": 0, "copied": 0}
+    cursor = mongo.db.users.find(
+        {"friends.0": {"$exists": True}}, {"friends": 1}, batch_size=batch_size
+    )
+    for users in batched(cursor, batch_size):
+        # a lagging secondary would make friends already copied look missing
+        existing = _bucket_friend_lists(
+            (user["_id"] for user in users), primary=True
+        )
+
+        buckets = []
+        for user in users:
+            have = set(existing.get(user["_id"], ()))
+            missing = [f for f in dict.fromkeys(user["friends"]) if f not in have]
+            for start in range(0, len(missing), size):
+                chunk = missing[start : start + size]
+                buckets.append(
+                    {"user_id": user["_id"], "count": len(chunk), "friends": chunk}
+                )
+                stats["copied"] += len(chunk)
+
+        if buckets:
+            mongo.db.friend_buckets.insert_many(buckets, ordered=False)
+        stats["users"] += len(users)
+        logger.info(f"Bucket migration: {stats['users']} users scanned")
+
+    return stats
+
+
+def drop_friend_arrays():
+    """Remove the embedded arrays once every worker runs on bucket storage."""
+    if storage() != "buckets":
+        raise RuntimeError("Switch FRIEND_STORAGE to buckets before dropping arrays")
+    result = mongo.db.users.update_many(
+        {"friends": {"$exists": True}}, {"$unset": {"friends": ""}}
+    )
+    return result.modified_count
@@ -8,10 +8,11 @@ import jwt
 from flask import current_app, g, request
 from werkzeug.datastructures import Authorization
 from werkzeug.exceptions import BadRequest, Unauthorized
-from werkzeug.security import check_password_hash
 
 from netwerker.app import mongo
+from netwerker.utils.cache import TTLCache
 from netwerker.utils.mongo_queries import get_user
+from netwerker.utils.passwords import password_hasher
 
 
 class BasicAuth(object):
@@ -70,12 +71,22 @@ class BasicAuth(object):
         """
 
         # lookup user in mongo database using the provided email
-        user, org = get_user(email=auth.username)
+        user = get_user(email=auth.username.lower())
+        org = user.get("org")
 
         # check the password hash
-        if not check_password_hash(user.get("passwordHash"), auth.password):
+        valid, new_hash = password_hasher.verify(
+            user.get("passwordHash"), auth.password
+        )
+        if not valid:
             raise Unauthorized("Invalid credentials")
 
+        # upgrade hashes stored with outdated cost parameters
+        if new_hash:
+            mongo.db.users.update_one(
+                {"_id": user["_id"]}, {"$set": {"passwordHash": new_hash}}
+            )
+
         return user, org
 
     def get_auth(self):
@@ -108,6 +119,11 @@ class TokenAuth(BasicAuth):
         # super().__init__(scheme, header)
         super(TokenAuth, self).__init__(scheme, header)
         self.verify_token_callback = None
+        self.cache = TTLCache()
+
+    def init_app(self, app):
+        self.cache.maxsize = app.config.get("TOKEN_CACHE_SIZE", self.cache.maxsize)
+        self.cache.ttl = app.config.get("TOKEN_CACHE_TTL", self.cache.ttl)
 
     def get_auth(self):
         """This method is to authorize tokens"""
@@ -137,26 +153,44 @@ class TokenAuth(BasicAuth):
 
     def authenticate(self, auth: Authorization):
         """
-        Authenticate the user. This method must be overridden in a subclass.
+        Authenticate the user. Verified tokens and the user they resolve to are
+        cached until the token expires, the cache TTL runs out, or the user is
+        invalidated with :meth:`invalidate_user`.
         """
+        raw_token = auth.get("token")
+        cached = self.cache.get(raw_token)
+        if cached is not None:
+            user, org = cached
+            return dict(user), org
 
-        if False:  # placeholder for future token validation
-            raise Unauthorized("Invalid credentials")
-        else:
-            try:
-                token = jwt.decode(
-                    auth.get("token"),
-                    current_app.config["SECRET_KEY"],
-                    algorithms=["HS256"],
-                )
-            except jwt.ExpiredSignatureError:
-                raise Unauthorized("Token expired")
-            except jwt.InvalidTokenError:
-                raise Unauthorized("Invalid token")
-
-            user, org = get_user(token.get("uuid"))
+        try:
+            token = jwt.decode(
+                raw_token,
+                current_app.config["SECRET_KEY"],
+                algorithms=["HS256"],
+            )
+        except jwt.ExpiredSignatureError:
+            raise Unauthorized("Token expired")
+        except jwt.InvalidTokenError:
+            raise Unauthorized("Invalid token")
+
+        user = get_user(uuid=token.get("uuid"))
+        user.pop("passwordHash", None)
+        org = token.get("org")
+
+        self.cache.set(
+            raw_token, (user, org), expires_at=token.get("exp"), tag=user["uuid"]
+        )
 
-        return user, org
+        return dict(user), org
+
+    def invalidate_user(self, uuid: str):
+        """Drop every cached token for a user, e.g. after their details change.
+
+        Only this worker's cache is cleared; other workers pick up the change
+        once TOKEN_CACHE_TTL runs out.
+        """
+        self.cache.invalidate_tag(uuid)
 
     @staticmethod
     def generate_token(user, org, ttype="access"):
@@ -0,0 +1,178 @@
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+import xxhash
+
+from netwerker.app import logger
+
+MAGIC = b"NWBL0002"
+# magic, source size, source mtime in ns, number of slots, string area offset
+HEADER = struct.Struct("<8sQqII")
+SLOT = struct.Struct("<I")
+LENGTH = struct.Struct("<H")
+
+
+def _slot(domain: bytes, n_slots: int):
+    return xxhash.xxh64_intdigest(domain) & (n_slots - 1)
+
+
+def _stamp(source: str):
+    st = os.stat(source)
+    return st.st_size, st.st_mtime_ns
+
+
+def compile_blocklist(source: str, target: str):
+    """
+    Compile a text blocklist, one domain per line, into a hash table file.
+
+    The file is an open addressing table of string offsets followed by the
+    length-prefixed domains, so it can be memory mapped and probed without
+    being parsed. The header records the size and mtime of the source it was
+    built from. It is written to a temporary file and renamed into place,
+    so readers never see a partial file.
+    """
+    size, mtime = _stamp(source)
+    with open(source, encoding="utf-8") as f:
+        domains = {
+            line.strip().lower().encode("utf-8")
+            for line in f
+            if line.strip() and not line.startswith("#")
+        }
+
+    n_slots = 1
+    while n_slots < 2 * len(domains):
+        n_slots *= 2
+
+    slots = [0] * n_slots
+    strings = bytearray()
+    strings_offset = HEADER.size + n_slots * SLOT.size
+    for domain in sorted(domains):
+        i = _slot(domain, n_slots)
+        while slots[i]:
+            i = (i + 1) & (n_slots - 1)
+        # offsets are stored +1 so that 0 marks an empty slot
+        slots[i] = len(strings) + 1
+        strings += LENGTH.pack(len(domain)) + domain
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target))
+    with os.fdopen(fd, "wb") as f:
+        f.write(HEADER.pack(MAGIC, size, mtime, n_slots, strings_offset))
+        f.write(struct.pack(f"<{n_slots}I", *slots))
+        f.write(strings)
+    os.replace(tmp, target)
+
+    return len(domains)
+
+
+class DomainBlocklist(object):
+    """
+    Memory mapped, hot reloadable blocklist of email domains.
+
+    The text list is compiled once into a hash table file which every worker
+    maps read-only, so all workers share one copy through the page cache.
+    A lookup probes the table for the domain and each of its parent domains
+    (``a.mail.ru``, ``mail.ru``, ``ru``), so subdomains of a blocked domain
+    are caught with a handful of constant-time probes.
+
+    The source file is checked at most every ``check_interval`` seconds and
+    recompiled and remapped when its size or mtime no longer match the ones
+    recorded in the compiled header. The compiled file is named after the
+    source's full path, so checkouts with different lists never share it.
+    """
+
+    def __init__(
+        self, source: str, cache_dir: str = None, check_interval: float = 5.0
+    ):
+        self.source = source
+        cache_dir = cache_dir or tempfile.gettempdir()
+        path_hash = xxhash.xxh64_hexdigest(os.path.realpath(source).encode("utf-8"))
+        self.compiled = os.path.join(
+            cache_dir, f"{os.path.basename(source)}.{path_hash}.idx"
+        )
+        self.check_interval = check_interval
+        self._table = None  # (mmap, number of slots), swapped as one reference
+        self._stamp = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def _map(self):
+        """Map the compiled file, or return None if it is missing or invalid."""
+        try:
+            with open(self.compiled, "rb") as f:
+                new_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # ValueError is raised for an empty file
+            return None
+
+        if len(new_map) < HEADER.size or new_map[: len(MAGIC)] != MAGIC:
+            new_map.close()
+            return None
+        return new_map
+
+    def _load(self):
+        stamp = _stamp(self.source)
+        new_map = self._map()
+        if new_map is not None and HEADER.unpack_from(new_map)[1:3] != stamp:
+            new_map.close()
+            new_map = None
+
+        if new_map is None:
+            count = compile_blocklist(self.source, self.compiled)
+            logger.info(f"Compiled {count} blocked domains into {self.compiled}")
+            new_map = self._map()
+            if new_map is None:
+                raise ValueError(f"{self.compiled} is not a compiled blocklist")
+
+        _, size, mtime, n_slots, _ = HEADER.unpack_from(new_map)
+        # readers holding the old map keep it alive until they finish
+        self._table = (new_map, n_slots)
+        # the stamp the table was built from, if the source changed while it
+        # was compiled the next check sees the mismatch and compiles again
+        self._stamp = (size, mtime)
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._table is not None and now - self._checked < self.check_interval:
+            return
+
+        with self._lock:
+            self._checked = now
+            if self._table is None or _stamp(self.source) != self._stamp:
+                self._load()
+
+    @staticmethod
+    def _contains(table, domain: bytes):
+        data, n_slots = table
+        strings_offset = HEADER.size + n_slots * SLOT.size
+        i = _slot(domain, n_slots)
+        while True:
+            (offset,) = SLOT.unpack_from(data, HEADER.size + i * SLOT.size)
+            if not offset:
+                return False
+            start = strings_offset + offset - 1
+            (length,) = LENGTH.unpack_from(data, start)
+            start += LENGTH.size
+            if data[start : start + length] == domain:
+                return True
+            i = (i + 1) & (n_slots - 1)
+
+    def blocked(self, domain: str):
+        """
+        Check whether a domain or any of its parent domains is blocked.
+
+        Parameters
+        ----------
+        domain : str
+            Lowercase, IDNA encoded domain name
+        """
+        self._refresh()
+        table = self._table
+
+        labels = domain.encode("utf-8").split(b".")
+        return any(
+            self._contains(table, b".".join(labels[i:])) for i in range(len(labels))
+        )
@@ -0,0 +1,231 @@
+import time
+from itertools import islice
+
+from marshmallow import ValidationError
+from pymongo.errors import BulkWriteError
+
+from netwerker.api.user.schemas import UserSchema
+from netwerker.app import logger, mongo
+from netwerker.utils.adjacency import add_friendships
+from netwerker.utils.graph import friend_graph
+from netwerker.utils.misc import bump_graph_epoch, friendship_document, user_document
+from netwerker.utils.passwords import password_hasher
+
+DUPLICATE_KEY = 11000
+
+
+def batched(iterable, size: int):
+    """Yield lists of up to ``size`` items from an iterable."""
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def _insert_unordered(collection, docs):
+    """
+    insert_many with ordered=False, treating duplicate keys as already done.
+
+    Returns
+    -------
+    result : tuple
+        (inserted documents, number of duplicates)
+    """
+    if not docs:
+        return [], 0
+
+    try:
+        collection.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        errors = e.details["writeErrors"]
+        fatal = [err for err in errors if err["code"] != DUPLICATE_KEY]
+        if fatal:
+            raise
+        failed = {err["index"] for err in errors}
+        return [doc for i, doc in enumerate(docs) if i not in failed], len(failed)
+
+    return docs, 0
+
+
+def ingest_friendships(pairs, batch_size: int = 1000):
+    """
+    Add many friendships at once.
+
+    Each batch resolves its uuids with one ``$in`` query, dedupes the pairs by
+    friendship hash and skips pairs whose friends document already exists.
+    As in UserFriends.post, the friend lists are written first, with one
+    bulk_write (see :func:`netwerker.utils.adjacency.add_friendships`), and
+    the friends documents last, with an unordered insert_many. A pair is only
+    skipped once its friends document exists, and writing friend lists again
+    is harmless, so an interrupted run can simply be restarted.
+
+    Parameters
+    ----------
+    pairs : iterable of tuple
+        (uuid, uuid) pairs
+    batch_size : int
+        Number of pairs handled per round trip
+
+    Returns
+    -------
+    stats : dict
+        Counts of pairs read, friendships created, duplicates, invalid pairs,
+        elapsed seconds and friendships created per second
+    """
+    stats = {"pairs": 0, "created": 0, "duplicates": 0, "invalid": 0}
+    started = time.perf_counter()
+
+    for batch in batched(pairs, batch_size):
+        stats["pairs"] += len(batch)
+
+        uuids = {uuid for pair in batch for uuid in pair}
+        ids = {
+            user["uuid"]: user["_id"]
+            for user in mongo.db.users.find(
+                {"uuid": {"$in": list(uuids)}}, {"uuid": 1}
+            )
+        }
+
+        docs = {}
+        for uuid_1, uuid_2 in batch:
+            _id_1, _id_2 = ids.get(uuid_1), ids.get(uuid_2)
+            if _id_1 is None or _id_2 is None or _id_1 == _id_2:
+                stats["invalid"] += 1
+                continue
+
+            doc = friendship_document(_id_1, _id_2)
+            if doc["friendship_hash"] in docs:
+                stats["duplicates"] += 1
+                continue
+            docs[doc["friendship_hash"]] = doc
+
+        existing = mongo.db.friends.find(
+            {"friendship_hash": {"$in": list(docs)}}, {"friendship_hash": 1}
+        )
+        for doc in existing:
+            del docs[doc["friendship_hash"]]
+            stats["duplicates"] += 1
+
+        if docs:
+            add_friendships([(d["user1_id"], d["user2_id"]) for d in docs.values()])
+
+            # a pair added concurrently since the check fails on the unique index
+            inserted, duplicates = _insert_unordered(
+                mongo.db.friends, list(docs.values())
+            )
+            stats["duplicates"] += duplicates
+            stats["created"] += len(inserted)
+
+            for doc in inserted:
+                friend_graph.add_edge(doc["user1_id"], doc["user2_id"])
+            bump_graph_epoch()
+
+        elapsed = time.perf_counter() - started
+        logger.info(
+            f"Ingested {stats['pairs']} pairs, {stats['created']} created"
+            f" ({stats['created'] / elapsed:.0f}/s)"
+        )
+
+    stats["seconds"] = time.perf_counter() - started
+    stats["per_second"] = (
+        stats["created"] / stats["seconds"] if stats["seconds"] else 0
+    )
+
+    return stats
+
+
+def import_users(records, batch_size: int = 1000, executor=None, on_error=None):
+    """
+    Create many users at once.
+
+    Each batch is validated with UserSchema, checked against existing emails
+    with one ``$in`` query, hashed across a process pool and written with an
+    unordered insert_many. A bad record is reported and skipped, the rest of
+    the run carries on.
+
+    Parameters
+    ----------
+    records : iterable of dict
+        Raw user records with name, email and password
+    batch_size : int
+        Number of records handled per round trip
+    executor : ProcessPoolExecutor
+        Pool for password hashing, see :meth:`PasswordHasher.hash_many`
+    on_error : callable
+        Called with (record number, error messages) for every skipped record,
+        numbered from 1 in input order. Errors are logged when not given.
+
+    Returns
+    -------
+    stats : dict
+        Counts of records read, users created, records failed, elapsed
+        seconds and users created per second
+    """
+    if on_error is None:
+
+        def on_error(number, messages):
+            logger.warning(f"User import record {number} skipped: {messages}")
+
+    schema = UserSchema()
+    stats = {"records": 0, "created": 0, "failed": 0}
+    started = time.perf_counter()
+
+    def fail(number, messages):
+        stats["failed"] += 1
+        on_error(number, messages)
+
+    for batch in batched(enumerate(records, 1), batch_size):
+        stats["records"] += len(batch)
+
+        valid = {}
+        for number, record in batch:
+            try:
+                data = schema.load(record)
+            except ValidationError as e:
+                fail(number, e.messages)
+                continue
+
+            email = data["email"].lower()
+            if email in valid:
+                fail(number, {"email": ["duplicate email in input"]})
+                continue
+            valid[email] = (number, data)
+
+        existing = {
+            user["email"]
+            for user in mongo.db.users.find(
+                {"email": {"$in": list(valid)}}, {"email": 1}
+            )
+        }
+        for email in existing:
+            number, _ = valid.pop(email)
+            fail(number, {"email": ["user already exists"]})
+
+        numbers = [number for number, _ in valid.values()]
+        hashes = password_hasher.hash_many(
+            [data["password"] for _, data in valid.values()], executor=executor
+        )
+        docs = [
+            user_document(data, pword_hash)
+            for (_, data), pword_hash in zip(valid.values(), hashes)
+        ]
+
+        # the unique email index catches users created since the $in check
+        inserted, _ = _insert_unordered(mongo.db.users, docs)
+        inserted_docs = {id(doc) for doc in inserted}
+        for number, doc in zip(numbers, docs):
+            if id(doc) not in inserted_docs:
+                fail(number, {"email": ["user already exists"]})
+        stats["created"] += len(inserted)
+
+        elapsed = time.perf_counter() - started
+        logger.info(
+            f"Imported {stats['records']} records, {stats['created']} created"
+            f" ({stats['created'] / elapsed:.0f}/s)"
+        )
+
+    stats["seconds"] = time.perf_counter() - started
+    stats["per_second"] = (
+        stats["created"] / stats["seconds"] if stats["seconds"] else 0
+    )
+
+    return stats
@@ -0,0 +1,93 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """
+    Bounded, thread-safe LRU cache with a per-entry expiry time.
+
+    Entries may carry a tag so that every entry belonging to, for example, one
+    user can be dropped at once with :meth:`invalidate_tag`.
+    """
+
+    def __init__(self, maxsize: int = 10_000, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (expires_at, tag, value)
+        self._tags = {}  # tag -> set of keys
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            expires_at, tag, value = entry
+            if expires_at <= time.time():
+                self._remove(key)
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, expires_at: float = None, tag=None):
+        """
+        Store a value.
+
+        Parameters
+        ----------
+        key : hashable
+            Cache key
+        value : object
+            Value to store
+        expires_at : float (optional)
+            Unix time after which the entry is discarded. The cache TTL is used
+            when it is earlier or when expires_at is not given.
+        tag : hashable (optional)
+            Tag used to invalidate groups of entries
+        """
+        deadline = time.time() + self.ttl
+        if expires_at is not None:
+            deadline = min(deadline, expires_at)
+
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+            self._data[key] = (deadline, tag, value)
+            if tag is not None:
+                self._tags.setdefault(tag, set()).add(key)
+
+            while len(self._data) > self.maxsize:
+                self._remove(next(iter(self._data)))
+
+    def invalidate_tag(self, tag):
+        with self._lock:
+            for key in list(self._tags.get(tag, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._tags.clear()
+
+    def _remove(self, key):
+        _, tag, _ = self._data.pop(key)
+        if tag is not None:
+            keys = self._tags.get(tag)
+            keys.discard(key)
+            if not keys:
+                del self._tags[tag]
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {"size": len(self), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,194 @@
+import itertools
+import queue
+import random
+import threading
+import time
+
+import boto3
+from botocore.exceptions import ClientError, HTTPClientError
+from botocore.exceptions import ConnectionError as BotoConnectionError
+from werkzeug.exceptions import ServiceUnavailable
+
+from netwerker.app import logger
+
+
+class SESTransport(object):
+    """Sends messages through Amazon SES with one client reused for every call."""
+
+    def __init__(self, region_name: str = None):
+        self.region_name = region_name
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        # boto3 clients are thread safe, so one is shared by every worker
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = boto3.client("ses", region_name=self.region_name)
+        return self._client
+
+    def send(self, message: dict):
+        response = self.client.send_email(**message)
+        return response["MessageId"]
+
+
+class LocalTransport(object):
+    """Keeps messages in memory instead of sending them. For tests and benchmarks."""
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.sent = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def send(self, message: dict):
+        if self.delay:
+            time.sleep(self.delay)
+        with self._lock:
+            self.sent.append(message)
+            return f"local-{next(self._ids)}"
+
+
+TRANSPORTS = {"ses": SESTransport, "local": LocalTransport}
+
+# SES error codes worth retrying, anything else (MessageRejected, an unverified
+# sender, a bad address) fails the same way every time
+TRANSIENT_CODES = {
+    "Throttling",
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "RequestTimeout",
+    "ServiceUnavailable",
+    "InternalFailure",
+}
+
+
+def is_transient(error: Exception):
+    """Whether a failed send may succeed if it is retried."""
+    if isinstance(error, ClientError):
+        code = error.response.get("Error", {}).get("Code")
+        status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        return code in TRANSIENT_CODES or status >= 500
+    return isinstance(
+        error, (BotoConnectionError, HTTPClientError, ConnectionError, TimeoutError)
+    )
+
+
+class EmailDispatcher(object):
+    """
+    Background email delivery.
+
+    Messages are put on a bounded in-process queue and sent by a pool of
+    worker threads, so the request that queued them returns immediately.
+    Sends that fail with a throttling or transient error are retried with
+    exponential backoff and jitter, any other error fails the message at once.
+    """
+
+    def __init__(
+        self,
+        transport=None,
+        workers: int = 2,
+        max_queue: int = 1000,
+        max_retries: int = 3,
+        backoff: float = 0.5,
+    ):
+        self.transport = transport or SESTransport()
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.queue = queue.Queue(max_queue)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._metrics = {"queued": 0, "sent": 0, "retried": 0, "failed": 0}
+        self._metrics_lock = threading.Lock()
+
+    def init_app(self, app):
+        transport = TRANSPORTS[app.config.get("EMAIL_TRANSPORT", "ses")]
+        self.transport = transport()
+        self.workers = app.config.get("EMAIL_WORKERS", self.workers)
+        self.max_retries = app.config.get("EMAIL_MAX_RETRIES", self.max_retries)
+        self.queue = queue.Queue(app.config.get("EMAIL_MAX_QUEUE", 1000))
+
+    def start(self):
+        """Start the worker threads if they are not running yet."""
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._work, name=f"email-dispatch-{i}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def enqueue(self, message: dict, timeout: float = 1.0):
+        """
+        Queue a message for delivery.
+
+        Parameters
+        ----------
+        message : dict
+            Keyword arguments for SES send_email: Destination, Message, Source
+        timeout : float
+            Seconds to wait for room on a full queue
+
+        Raises
+        ------
+        :class:`~werkzeug.exceptions.ServiceUnavailable`
+            Raised when the queue stays full for longer than timeout.
+        """
+        self.start()
+        try:
+            self.queue.put(message, timeout=timeout)
+        except queue.Full:
+            raise ServiceUnavailable("Email queue is full, try again later")
+        self._count("queued")
+
+    def _count(self, outcome: str):
+        # worker threads update the counters while metrics are scraped
+        with self._metrics_lock:
+            self._metrics[outcome] += 1
+
+    def stats(self):
+        """Snapshot of the dispatch counters."""
+        with self._metrics_lock:
+            return dict(self._metrics)
+
+    def send(self, message: dict):
+        """Send a message on the calling thread, retrying transient failures."""
+        for attempt in range(self.max_retries + 1):
+            try:
+                message_id = self.transport.send(message)
+            except Exception as e:
+                if attempt == self.max_retries or not is_transient(e):
+                    self._count("failed")
+                    raise
+                self._count("retried")
+                delay = self.backoff * 2**attempt * (1 + random.random())
+                logger.warning(f"Email send failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+            else:
+                self._count("sent")
+                return message_id
+
+    def _work(self):
+        while True:
+            message = self.queue.get()
+            to = message["Destination"]["ToAddresses"]
+            try:
+                message_id = self.send(message)
+            except Exception as e:
+                logger.error(f"Email to {to} dropped: {e}")
+            else:
+                logger.info(f"Email sent to {to}, message ID: {message_id}")
+            finally:
+                self.queue.task_done()
+
+    def join(self):
+        """Block until every queued message has been handled."""
+        self.queue.join()
+
+
+email_dispatcher = EmailDispatcher()
@@ -0,0 +1,170 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from werkzeug.exceptions import BadRequest
+
+from netwerker.app import logger, mongo
+from netwerker.utils.adjacency import get_friend_ids, reads_arrays
+from netwerker.utils.bulk import batched
+from netwerker.utils.email_dispatch import email_dispatcher
+from netwerker.utils.messaging import route_recipient
+from netwerker.utils.mongo_queries import get_user
+
+
+class CompiledEmail(object):
+    """
+    The three templates of an email, loaded and compiled once.
+
+    Rendering a compiled template skips the lookup and context processing
+    render_template does on every call.
+    """
+
+    def __init__(self, template: str, sender: str):
+        env = current_app.jinja_env
+        self.name = template
+        self.sender = sender
+        self.html = env.get_template(f"{template}.html")
+        self.text = env.get_template(f"{template}.txt")
+        self.subject = env.get_template(f"{template}-subject.txt")
+
+    def render(self, to: str, **context):
+        return {
+            "Destination": {"ToAddresses": [to]},
+            "Message": {
+                "Subject": {"Charset": "utf-8", "Data": self.subject.render(context)},
+                "Body": {
+                    "Html": {"Charset": "utf-8", "Data": self.html.render(context)},
+                    "Text": {"Charset": "utf-8", "Data": self.text.render(context)},
+                },
+            },
+            "Source": self.sender,
+        }
+
+
+class RateLimiter(object):
+    """Token bucket allowing ``rate`` operations per second."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._allowance = rate
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, n: int = 1):
+        """Take n tokens, sleeping until the bucket has paid them back."""
+        with self._lock:
+            now = time.monotonic()
+            self._allowance = min(
+                self.rate, self._allowance + (now - self._last) * self.rate
+            )
+            self._last = now
+            self._allowance -= n
+            if self._allowance < 0:
+                time.sleep(-self._allowance / self.rate)
+
+
+def segment_recipients(segment: str, uuid: str = None, batch_size: int = 1000):
+    """
+    Stream the users in a segment from a Mongo cursor.
+
+    Parameters
+    ----------
+    segment : str
+        "all" for every user, "friends" for the friends of ``uuid``
+    uuid : str
+        User whose friends to select, required for the "friends" segment
+    """
+    projection = {"email": 1, "name": 1, "_id": 0}
+    if segment == "all":
+        query = {}
+    elif segment == "friends":
+        if not uuid:
+            raise BadRequest("uuid is required for the friends segment")
+        user = get_user(uuid=uuid, get_friends=reads_arrays())
+        query = {"_id": {"$in": get_friend_ids(user)}}
+    else:
+        raise BadRequest(f"Unknown segment {segment}")
+
+    return mongo.db.users.find(query, projection, batch_size=batch_size)
+
+
+def fan_out(
+    template: str,
+    recipients,
+    context: dict = None,
+    sender: str = "NeTwerker No Reply <no-reply@netwerker.com>",
+    chunk_size: int = 50,
+    rate: float = 14.0,
+    workers: int = 4,
+    transport=None,
+):
+    """
+    Send one template to many recipients.
+
+    Templates are compiled once. Recipients are read lazily and rendered in
+    parallel a chunk at a time. Messages are then sent one by one over the
+    transport's shared client, each waiting for its token, so sends never
+    exceed ``rate`` per second even in bursts.
+
+    Parameters
+    ----------
+    template : str
+        Template name without extension, as for send_email
+    recipients : iterable of dict
+        User documents with "email" and "name", typically a cursor from
+        :func:`segment_recipients`
+    context : dict
+        Replacement values shared by every message. Each message also gets
+        user_name set from the recipient.
+    chunk_size : int
+        Messages rendered per round of the thread pool
+    rate : float
+        Maximum messages per second, SES accounts default to 14
+    workers : int
+        Rendering threads
+    transport : object
+        Transport with a send method, the dispatcher's by default
+
+    Returns
+    -------
+    stats : dict
+        Messages sent, messages failed and elapsed seconds
+    """
+    compiled = CompiledEmail(template, sender)
+    transport = transport or email_dispatcher.transport
+    limiter = RateLimiter(rate)
+    context = context or {}
+    stats = {"sent": 0, "failed": 0}
+    started = time.perf_counter()
+
+    app = current_app._get_current_object()
+
+    def render(user):
+        # worker threads need their own app context for the DEV routing check
+        with app.app_context():
+            return compiled.render(
+                route_recipient(user["email"]), user_name=user.get("name"), **context
+            )
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for chunk in batched(recipients, chunk_size):
+            for message in pool.map(render, chunk):
+                limiter.acquire()
+                try:
+                    transport.send(message)
+                except Exception as e:
+                    stats["failed"] += 1
+                    to = message["Destination"]["ToAddresses"][0]
+                    logger.error(f"Fan-out message to {to} failed: {e}")
+                else:
+                    stats["sent"] += 1
+
+    stats["seconds"] = time.perf_counter() - started
+    logger.info(
+        f'Fan-out of "{template}": {stats["sent"]} sent, {stats["failed"]} failed'
+        f' in {stats["seconds"]:.1f}s'
+    )
+
+    return stats
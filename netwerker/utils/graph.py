@@ -0,0 +1,430 @@
+import os
+import sys
+import threading
+import time
+from array import array
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+from netwerker.app import logger, mongo
+from netwerker.utils.adjacency import iter_adjacency
+from netwerker.utils.graph_snapshot import GraphSnapshot, SnapshotIds, write_snapshot
+
+# friendships stamped by app servers with slightly slow clocks are still replayed
+REPLAY_SKEW = timedelta(minutes=1)
+
+
+class _GraphState(object):
+    """
+    One consistent version of the graph.
+
+    A state's CSR arrays are never changed after it is published, compaction
+    and the loaders build a new state in locals and swap it in with a single
+    assignment. Between swaps writers only append to the id mapping, the
+    overlay and the tombstones, under the graph's lock, one entry at a time.
+    Readers take ``graph._state`` once and keep using it, so they never see
+    the offsets of one version with the neighbors of another.
+    """
+
+    __slots__ = (
+        "index",
+        "ids",
+        "offsets",
+        "neighbors",
+        "overlay",
+        "overlay_edges",
+        "removed",
+        "removed_edges",
+        "snapshot",
+    )
+
+    def __init__(self, index=None, ids=None, snapshot=None):
+        self.index = {} if index is None else index  # ObjectId -> dense id
+        self.ids = [] if ids is None else ids  # dense id -> ObjectId
+        self.offsets = array("Q", [0])
+        self.neighbors = array("I")
+        self.overlay = {}  # dense id -> array("I") of edges not yet compacted
+        self.overlay_edges = 0
+        self.removed = {}  # dense id -> set of dense ids no longer friends
+        self.removed_edges = 0
+        self.snapshot = snapshot
+
+    def node(self, _id: ObjectId, create: bool = True):
+        node = self.index.get(_id)
+        if node is None and create:
+            node = len(self.ids)
+            # listed before it is indexed, so a found id always resolves
+            self.ids.append(_id)
+            self.index[_id] = node
+        return node
+
+    @property
+    def edge_count(self):
+        return (len(self.neighbors) + self.overlay_edges - self.removed_edges) // 2
+
+    def stored_friends_of(self, node: int):
+        offsets = self.offsets
+        if node + 1 < len(offsets):
+            yield from self.neighbors[offsets[node] : offsets[node + 1]]
+        if node in self.overlay:
+            yield from self.overlay[node]
+
+    def friends_of(self, node: int):
+        removed = self.removed.get(node)
+        if removed:
+            for friend in self.stored_friends_of(node):
+                if friend not in removed:
+                    yield friend
+        else:
+            yield from self.stored_friends_of(node)
+
+
+def _build_csr(adjacency, count: int):
+    """CSR (offsets, neighbors) arrays for per-node lists of dense ids."""
+    offsets = array("Q", [0])
+    neighbors = array("I")
+    for node in range(count):
+        friends = adjacency[node] if node < len(adjacency) else None
+        if friends:
+            neighbors.extend(friends)
+        offsets.append(len(neighbors))
+    return offsets, neighbors
+
+
+class FriendGraph(object):
+    """
+    In-memory friendship graph stored in compressed sparse row (CSR) form.
+
+    User ObjectIds are mapped to dense integer ids. The adjacency of node ``n``
+    is ``neighbors[offsets[n]:offsets[n + 1]]``, both held in typed arrays, so
+    each edge costs 4 bytes per direction instead of a Python object.
+
+    Edges added after the CSR arrays were built are kept in a small per-node
+    overlay and folded back into the CSR arrays once the overlay grows past
+    ``compact_threshold`` edges. Removed edges are hidden by per-node
+    tombstones until the next compaction drops them.
+
+    The graph is either built from Mongo with :meth:`load` or mapped from a
+    snapshot file with :meth:`load_snapshot`, in which case the CSR arrays and
+    the id dictionary are read in place from the shared mapping until the
+    first compaction copies the arrays into the process.
+
+    Writers serialize on a lock, readers take none: everything they read
+    lives in one :class:`_GraphState` that writers replace as a whole.
+    """
+
+    def __init__(self, compact_threshold: int = 100_000):
+        self.compact_threshold = compact_threshold
+        self.snapshot_path = None
+        self.enabled = False
+        self.loaded = False
+        # graph epoch the graph is known to reflect, see :meth:`catch_up`
+        self.epoch = -1
+        self._synced_at = None
+        self._lock = threading.RLock()
+        self._state = _GraphState()
+
+    def init_app(self, app):
+        self.enabled = app.config.get("GRAPH_ENGINE", False)
+        self.compact_threshold = app.config.get(
+            "GRAPH_COMPACT_THRESHOLD", self.compact_threshold
+        )
+        self.snapshot_path = app.config.get("GRAPH_SNAPSHOT_PATH") or None
+
+    def load(self, batch_size: int = 10_000):
+        """Build the graph from the stored friend lists, see :mod:`adjacency`."""
+        started = time.perf_counter()
+        with self._lock:
+            epoch, synced_at = self._current_epoch()
+            state = _GraphState()
+            adjacency = []
+            for user_id, friends in iter_adjacency(batch_size=batch_size):
+                node = state.node(user_id)
+                while len(adjacency) <= node:
+                    adjacency.append(None)
+                if adjacency[node] is None:
+                    adjacency[node] = []
+                # a user spans several documents with bucket storage
+                adjacency[node].extend(state.node(friend_id) for friend_id in friends)
+
+            state.offsets, state.neighbors = _build_csr(adjacency, len(state.ids))
+            self._state = state
+            self.epoch, self._synced_at = epoch, synced_at
+            self.loaded = True
+
+        logger.info(
+            f"Friend graph loaded: {self.node_count} users, {self.edge_count} edges,"
+            f" {self.memory_usage()['total_bytes']} bytes in"
+            f" {time.perf_counter() - started:.2f}s"
+        )
+
+    def load_snapshot(self, path: str):
+        """
+        Map a snapshot written by :meth:`save_snapshot` and replay newer edges.
+
+        Returns
+        -------
+        replayed : int
+            Friendships created after the snapshot that were added to it
+        """
+        started = time.perf_counter()
+        snapshot = GraphSnapshot(path)
+        ids = SnapshotIds(snapshot)
+        with self._lock:
+            state = _GraphState(index=ids, ids=ids, snapshot=snapshot)
+            state.offsets = snapshot.offsets
+            state.neighbors = snapshot.neighbors
+            self._state = state
+            self.loaded = True
+            epoch, synced_at = self._current_epoch()
+            replayed = self.replay(snapshot.created_at - REPLAY_SKEW)
+            self.epoch, self._synced_at = epoch, synced_at
+
+        logger.info(
+            f"Friend graph mapped from {path}: {self.node_count} users,"
+            f" {self.edge_count} edges, {replayed} replayed in"
+            f" {time.perf_counter() - started:.2f}s"
+        )
+        return replayed
+
+    def save_snapshot(self, path: str, created_at: datetime):
+        """
+        Write the graph to a snapshot file, see :mod:`graph_snapshot`.
+
+        Nodes are renumbered in ObjectId order so the file's id dictionary
+        can be binary searched.
+
+        Parameters
+        ----------
+        created_at : datetime
+            Naive UTC time from before the graph was read, edges created since
+            are replayed when the snapshot is loaded
+        """
+        with self._lock:
+            state = self._state
+            count = len(state.ids)
+            order = sorted(range(count), key=state.ids.__getitem__)
+            rank = array("I", bytes(4 * count))
+            for new, old in enumerate(order):
+                rank[old] = new
+
+            offsets = array("Q", [0])
+            neighbors = array("I")
+            for old in order:
+                neighbors.extend(rank[friend] for friend in state.friends_of(old))
+                offsets.append(len(neighbors))
+
+            ids = [state.ids[old] for old in order]
+
+        write_snapshot(path, ids, offsets, neighbors, created_at)
+        logger.info(
+            f"Friend graph snapshot written to {path}: {len(ids)} users,"
+            f" {len(neighbors) // 2} edges, {os.path.getsize(path)} bytes"
+        )
+
+    def _current_epoch(self):
+        # misc answers graph queries through this module
+        from netwerker.utils.misc import get_graph_epoch
+
+        return get_graph_epoch(), datetime.utcnow()
+
+    def catch_up(self, epoch: int):
+        """
+        Replay friendships written since the last sync if ``epoch`` is newer.
+
+        Graph sync delivers other workers' and the CLI's writes a moment
+        late. Catching up first keeps a result cached under ``epoch`` from
+        being computed on an older graph. Only added friendships are
+        replayed, removals still arrive through graph sync.
+
+        Returns
+        -------
+        replayed : int
+            Friendships that were missing from the graph
+        """
+        if not self.loaded or epoch <= self.epoch:
+            return 0
+
+        with self._lock:
+            if epoch <= self.epoch:
+                return 0
+            synced_at = datetime.utcnow()
+            replayed = self.replay(self._synced_at - REPLAY_SKEW)
+            self.epoch, self._synced_at = epoch, synced_at
+        return replayed
+
+    def replay(self, since: datetime):
+        """Add friendships created at or after ``since`` that are missing."""
+        replayed = 0
+        cursor = mongo.db.friends.find(
+            {"created_at": {"$gte": since}}, {"user1_id": 1, "user2_id": 1}
+        ).sort("created_at", 1)
+        for doc in cursor:
+            if self.add_edge(doc["user1_id"], doc["user2_id"]):
+                replayed += 1
+        return replayed
+
+    def compact(self):
+        """Fold the overlay edges and tombstones into the CSR arrays."""
+        with self._lock:
+            current = self._state
+            count = len(current.ids)
+            adjacency = [list(current.friends_of(node)) for node in range(count)]
+            # ids only ever grow, the new state keeps sharing them
+            state = _GraphState(current.index, current.ids, current.snapshot)
+            state.offsets, state.neighbors = _build_csr(adjacency, count)
+            self._state = state
+
+    def add_edge(self, user_id_1: ObjectId, user_id_2: ObjectId):
+        """
+        Record a new bi-directional friendship.
+
+        A no-op for an edge already in the graph, so the request that wrote
+        a friendship and the graph sync seeing it may both add it.
+
+        Returns
+        -------
+        added : bool
+            Whether the edge was missing and has been added
+        """
+        if not self.loaded:
+            return False
+
+        with self._lock:
+            state = self._state
+            node_1, node_2 = state.node(user_id_1), state.node(user_id_2)
+            if node_2 in state.removed.get(node_1, ()):
+                # re-added before compaction, the stored edge is still there
+                state.removed[node_1].discard(node_2)
+                state.removed[node_2].discard(node_1)
+                state.removed_edges -= 2
+                return True
+            if node_2 in state.friends_of(node_1):
+                return False
+
+            state.overlay.setdefault(node_1, array("I")).append(node_2)
+            state.overlay.setdefault(node_2, array("I")).append(node_1)
+            state.overlay_edges += 2
+            if state.overlay_edges >= self.compact_threshold:
+                self.compact()
+            return True
+
+    def remove_edge(self, user_id_1: ObjectId, user_id_2: ObjectId):
+        """Drop a bi-directional friendship."""
+        if not self.loaded:
+            return
+
+        with self._lock:
+            if not self.has_edge(user_id_1, user_id_2):
+                return
+            state = self._state
+            node_1, node_2 = state.node(user_id_1), state.node(user_id_2)
+            state.removed.setdefault(node_1, set()).add(node_2)
+            state.removed.setdefault(node_2, set()).add(node_1)
+            state.removed_edges += 2
+            if state.removed_edges >= self.compact_threshold:
+                self.compact()
+
+    def remove_user(self, user_id: ObjectId):
+        """Drop every friendship of a user."""
+        node = self.node_id(user_id)
+        if node is None:
+            return
+
+        with self._lock:
+            for friend in list(self.friends_of(node)):
+                self.remove_edge(user_id, self.user_id(friend))
+
+    def has_edge(self, user_id_1: ObjectId, user_id_2: ObjectId):
+        state = self._state
+        node_1 = state.node(user_id_1, create=False)
+        node_2 = state.node(user_id_2, create=False)
+        if node_1 is None or node_2 is None:
+            return False
+        return node_2 in state.friends_of(node_1)
+
+    def node_id(self, user_id: ObjectId):
+        """Dense id of a user, or None if the user has no edges in the graph."""
+        return self._state.index.get(user_id)
+
+    def user_id(self, node: int):
+        """ObjectId of a dense id."""
+        return self._state.ids[node]
+
+    def friends_of(self, node: int):
+        """Iterate over the dense ids of a node's friends."""
+        return self._state.friends_of(node)
+
+    @property
+    def node_count(self):
+        return len(self._state.ids)
+
+    @property
+    def edge_count(self):
+        """Number of undirected edges."""
+        return self._state.edge_count
+
+    def memory_usage(self):
+        """
+        Approximate memory held by the graph, in bytes.
+
+        Returns
+        -------
+        usage : dict
+            Byte counts for the CSR arrays, the id dictionary, the overlay of
+            added and removed edges and their total held by this process,
+            plus the size of the mapped snapshot shared with other processes.
+        """
+        state = self._state
+        # arrays still reading from the snapshot live in the shared mapping
+        csr = sum(
+            len(values) * values.itemsize
+            for values in (state.offsets, state.neighbors)
+            if isinstance(values, array)
+        )
+        if state.snapshot is not None:
+            id_map = state.ids.memory_usage()
+        else:
+            # each ObjectId instance plus its dict slot and list slot
+            id_map = (
+                sys.getsizeof(state.index)
+                + sys.getsizeof(state.ids)
+                + len(state.ids) * sys.getsizeof(ObjectId())
+            )
+        # copied first, writers may add nodes while the sizes are summed
+        overlay = (
+            sys.getsizeof(state.overlay)
+            + sum(sys.getsizeof(edges) for edges in list(state.overlay.values()))
+            + sys.getsizeof(state.removed)
+            + sum(sys.getsizeof(edges) for edges in list(state.removed.values()))
+        )
+
+        return {
+            "nodes": len(state.ids),
+            "edges": state.edge_count,
+            "csr_bytes": csr,
+            "id_map_bytes": id_map,
+            "overlay_bytes": overlay,
+            "total_bytes": csr + id_map + overlay,
+            "mapped_bytes": state.snapshot.size if state.snapshot else 0,
+        }
+
+    def ensure_loaded(self):
+        """
+        Load the graph on first use if the engine is enabled.
+
+        A snapshot at GRAPH_SNAPSHOT_PATH is mapped when one exists, otherwise
+        the graph is built from Mongo.
+        """
+        if self.enabled and not self.loaded:
+            with self._lock:
+                if not self.loaded:
+                    if self.snapshot_path and os.path.exists(self.snapshot_path):
+                        self.load_snapshot(self.snapshot_path)
+                    else:
+                        self.load()
+        return self.loaded
+
+
+friend_graph = FriendGraph()
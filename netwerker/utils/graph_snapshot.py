@@ -0,0 +1,169 @@
+"""
+Binary snapshot of the friend graph.
+
+Layout, all sections 8 byte aligned:
+
+    header     64 bytes, see HEADER
+    ids        node_count x 12 byte ObjectIds, sorted, so dense id = rank
+    offsets    (node_count + 1) x uint64 CSR offsets
+    neighbors  neighbor_count x uint32 dense ids
+
+The arrays are written in the byte order of the machine taking the snapshot
+and read back in place through a read-only mmap: loading costs no parsing and
+no copies, and every worker mapping the same file shares one copy of it in
+the page cache.
+"""
+
+import mmap
+import os
+import struct
+import sys
+from bisect import bisect_left
+from datetime import datetime
+
+from bson import ObjectId
+
+MAGIC = b"NWGRAPH\0"
+VERSION = 1
+FLAG_BIG_ENDIAN = 1
+
+# magic, version, flags, node count, neighbor count, created at (unix time),
+# ids offset, offsets offset, neighbors offset
+HEADER = struct.Struct("<8sIIQQdQQQ")
+ID_SIZE = 12
+
+
+def _align(position: int, alignment: int = 8):
+    return -(-position // alignment) * alignment
+
+
+def write_snapshot(path: str, ids: list, offsets, neighbors, created_at: datetime):
+    """
+    Write a graph in CSR form to ``path``.
+
+    The file is written next to ``path`` and renamed over it, so workers that
+    still map the previous snapshot keep reading a complete file.
+
+    Parameters
+    ----------
+    ids : list of ObjectId
+        Dense id -> ObjectId, sorted ascending
+    offsets : array
+        array("Q") of node_count + 1 CSR offsets
+    neighbors : array
+        array("I") of dense ids
+    created_at : datetime
+        Naive UTC time the graph was read from; replay starts from here
+    """
+    ids_at = _align(HEADER.size)
+    offsets_at = _align(ids_at + len(ids) * ID_SIZE)
+    neighbors_at = offsets_at + len(offsets) * offsets.itemsize
+    header = HEADER.pack(
+        MAGIC,
+        VERSION,
+        FLAG_BIG_ENDIAN if sys.byteorder == "big" else 0,
+        len(ids),
+        len(neighbors),
+        (created_at - datetime(1970, 1, 1)).total_seconds(),
+        ids_at,
+        offsets_at,
+        neighbors_at,
+    )
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header)
+        f.write(b"\0" * (ids_at - HEADER.size))
+        for _id in ids:
+            f.write(_id.binary)
+        f.write(b"\0" * (offsets_at - ids_at - len(ids) * ID_SIZE))
+        offsets.tofile(f)
+        neighbors.tofile(f)
+    os.replace(tmp_path, path)
+
+
+class GraphSnapshot(object):
+    """A snapshot file mapped read only."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (
+            magic,
+            version,
+            flags,
+            self.node_count,
+            neighbor_count,
+            created_at,
+            ids_at,
+            offsets_at,
+            neighbors_at,
+        ) = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a graph snapshot")
+        if version != VERSION:
+            raise ValueError(f"{path} is snapshot version {version}, not {VERSION}")
+        if bool(flags & FLAG_BIG_ENDIAN) != (sys.byteorder == "big"):
+            raise ValueError(f"{path} was written with a different byte order")
+
+        self.created_at = datetime.utcfromtimestamp(created_at)
+
+        view = memoryview(self._mmap)
+        self.ids = view[ids_at : ids_at + self.node_count * ID_SIZE]
+        self.offsets = view[offsets_at : offsets_at + (self.node_count + 1) * 8].cast(
+            "Q"
+        )
+        self.neighbors = view[neighbors_at : neighbors_at + neighbor_count * 4].cast(
+            "I"
+        )
+
+    @property
+    def size(self):
+        return len(self._mmap)
+
+
+class SnapshotIds(object):
+    """
+    ObjectId <-> dense id mapping backed by a snapshot's sorted id section.
+
+    Stands in for both FriendGraph's ``_index`` dict and ``_ids`` list. Ids
+    in the snapshot are found by binary search over the mapped bytes; users
+    added afterwards get dense ids past the snapshot's and are kept in
+    ordinary per-process containers.
+    """
+
+    def __init__(self, snapshot: GraphSnapshot):
+        self._view = snapshot.ids
+        self.base = snapshot.node_count
+        self._extra_index = {}
+        self._extra_ids = []
+
+    def __len__(self):
+        return self.base + len(self._extra_ids)
+
+    def __getitem__(self, node: int):
+        if node < self.base:
+            return ObjectId(bytes(self._view[node * ID_SIZE : (node + 1) * ID_SIZE]))
+        return self._extra_ids[node - self.base]
+
+    def get(self, _id: ObjectId, default=None):
+        node = bisect_left(self, _id, 0, self.base)
+        if node < self.base and self[node] == _id:
+            return node
+        return self._extra_index.get(_id, default)
+
+    def __setitem__(self, _id: ObjectId, node: int):
+        self._extra_index[_id] = node
+
+    def append(self, _id: ObjectId):
+        self._extra_ids.append(_id)
+
+    def memory_usage(self):
+        """Bytes held outside the mapped file."""
+        return (
+            sys.getsizeof(self._extra_index)
+            + sys.getsizeof(self._extra_ids)
+            + len(self._extra_ids) * sys.getsizeof(ObjectId())
+        )
@@ -0,0 +1,285 @@
+"""
+Incremental sync of derived graph state from MongoDB.
+
+Friendships added by one worker leave every other worker's derived state
+(the in-memory graph, cached distances, precomputed recommendations) stale.
+:class:`GraphSync` follows the ``friends`` and ``users`` collections and hands
+typed events to registered consumers:
+
+    graph_sync.register(lambda event: ...)
+
+On a replica set it reads a change stream. Remove events need the pre-images
+of deleted friends documents (MongoDB 6.0+)::
+
+    db.runCommand({collMod: "friends", changeStreamPreAndPostImages: {enabled: true}})
+
+Without a replica set it polls the friends collection by ``created_at``,
+which only sees new friendships.
+
+A named sync persists its position (resume token or poll cursor) in the
+``sync_state`` collection and picks up where it stopped after a restart. Web
+workers run unnamed: they load fresh state on start and follow from there.
+"""
+
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from pymongo.errors import OperationFailure, PyMongoError
+
+from netwerker.app import logger, mongo
+
+# server errors: no change streams here, no pre-images before MongoDB 6.0, or
+# the resume point has aged out of the oplog
+NOT_REPLICA_SET = 40573
+UNKNOWN_FIELD = 40415
+CHANGE_STREAM_HISTORY_LOST = 286
+
+# friendships stamped by a slightly slow app server clock are still polled
+POLL_LOOKBACK = timedelta(seconds=5)
+
+
+@dataclass(frozen=True)
+class EdgeAdded:
+    user1_id: ObjectId
+    user2_id: ObjectId
+
+
+@dataclass(frozen=True)
+class EdgeRemoved:
+    user1_id: ObjectId
+    user2_id: ObjectId
+
+
+@dataclass(frozen=True)
+class UserRemoved:
+    user_id: ObjectId
+
+
+def _event_from_change(change: dict):
+    """Typed event for a change stream document, or None if it is irrelevant."""
+    collection = change["ns"]["coll"]
+    operation = change["operationType"]
+
+    if collection == "friends" and operation == "insert":
+        doc = change["fullDocument"]
+        return EdgeAdded(doc["user1_id"], doc["user2_id"])
+
+    if collection == "friends" and operation == "delete":
+        doc = change.get("fullDocumentBeforeChange")
+        if doc is None:
+            logger.warning(
+                "Friendship deleted without a pre-image, enable"
+                " changeStreamPreAndPostImages on the friends collection"
+            )
+            return None
+        return EdgeRemoved(doc["user1_id"], doc["user2_id"])
+
+    if collection == "users" and operation == "delete":
+        return UserRemoved(change["documentKey"]["_id"])
+
+    return None
+
+
+class GraphSync(object):
+    """
+    Background thread turning friends and users changes into events.
+
+    Parameters
+    ----------
+    name : str
+        Key of the persisted position in ``sync_state``, None to start from
+        the current time on every start
+    """
+
+    def __init__(self, name: str = None):
+        self.name = name
+        self.enabled = False
+        self.mode = "auto"
+        self.poll_interval = 1.0
+        self.checkpoint_interval = 5.0
+        self.consumers = []
+        self.stats = {"events": 0, "consumer_errors": 0, "restarts": 0}
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._last_checkpoint = 0.0
+        self._pre_images = True
+
+    def init_app(self, app):
+        self.configure(app.config)
+        self.enabled = app.config.get("GRAPH_SYNC", False)
+        if self.enabled:
+            # started on the first request, after the server has forked workers
+            app.before_request(self.start)
+
+    def configure(self, config):
+        self.mode = config.get("GRAPH_SYNC_MODE", self.mode)
+        self.poll_interval = config.get("GRAPH_SYNC_POLL_SECONDS", self.poll_interval)
+
+    def register(self, consumer):
+        """Add a callable receiving every event. Usable as a decorator."""
+        self.consumers.append(consumer)
+        return consumer
+
+    def dispatch(self, event):
+        self.stats["events"] += 1
+        for consumer in self.consumers:
+            try:
+                consumer(event)
+            except Exception:
+                # one broken consumer must not starve the others
+                self.stats["consumer_errors"] += 1
+                logger.exception(f"Graph sync consumer {consumer!r} failed on {event}")
+
+    def start(self):
+        """Start the sync thread if it is not running yet."""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._stop.clear()
+                self._thread = threading.Thread(
+                    target=self.run, name="graph-sync", daemon=True
+                )
+                self._thread.start()
+
+    def stop(self, timeout: float = None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def run(self):
+        """Follow changes until :meth:`stop`, reconnecting after errors."""
+        use_change_stream = self.mode in ("auto", "change_stream")
+        while not self._stop.is_set():
+            try:
+                if use_change_stream:
+                    self._follow_change_stream()
+                else:
+                    self._poll()
+            except OperationFailure as e:
+                if e.code == NOT_REPLICA_SET and self.mode == "auto":
+                    logger.info("No replica set, graph sync falls back to polling")
+                    use_change_stream = False
+                    continue
+                if e.code == UNKNOWN_FIELD and self._pre_images:
+                    logger.warning("No pre-images before MongoDB 6.0, removals ignored")
+                    self._pre_images = False
+                    continue
+                if e.code == CHANGE_STREAM_HISTORY_LOST:
+                    logger.warning("Graph sync resume point lost, restarting at now")
+                    self._save_state({"resume_token": None})
+                    continue
+                self._backoff(e)
+            except PyMongoError as e:
+                self._backoff(e)
+
+    def _backoff(self, error):
+        self.stats["restarts"] += 1
+        logger.error(f"Graph sync interrupted, retrying: {error}")
+        self._stop.wait(min(30.0, 2 ** min(self.stats["restarts"], 5)))
+
+    def _load_state(self):
+        if self.name is None:
+            return {}
+        return mongo.db.sync_state.find_one({"_id": self.name}) or {}
+
+    def _save_state(self, state: dict, force: bool = True):
+        if self.name is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_checkpoint < self.checkpoint_interval:
+            return
+        self._last_checkpoint = now
+        mongo.db.sync_state.update_one(
+            {"_id": self.name},
+            {"$set": dict(state, updated_at=datetime.utcnow())},
+            upsert=True,
+        )
+
+    def _follow_change_stream(self):
+        pipeline = [
+            {
+                "$match": {
+                    "ns.coll": {"$in": ["friends", "users"]},
+                    "operationType": {"$in": ["insert", "delete"]},
+                }
+            }
+        ]
+        options = {
+            "resume_after": self._load_state().get("resume_token"),
+            "max_await_time_ms": int(self.poll_interval * 1000),
+        }
+        if self._pre_images:
+            options["full_document_before_change"] = "whenAvailable"
+
+        with mongo.db.watch(pipeline, **options) as stream:
+            while not self._stop.is_set() and stream.alive:
+                change = stream.try_next()
+                if change is not None:
+                    event = _event_from_change(change)
+                    if event is not None:
+                        self.dispatch(event)
+                # also checkpoints while idle, the token moves past other writes
+                self._save_state({"resume_token": stream.resume_token}, force=False)
+            self._save_state({"resume_token": stream.resume_token})
+
+    def _poll(self):
+        state = self._load_state().get("poll_position") or {}
+        position = state.get("created_at") or datetime.utcnow()
+        # ids handled within the lookback window, so rereading it is harmless
+        seen = {}
+
+        while not self._stop.is_set():
+            since = position - POLL_LOOKBACK
+            cursor = mongo.db.friends.find(
+                {"created_at": {"$gte": since}},
+                {"user1_id": 1, "user2_id": 1, "created_at": 1},
+            ).sort("created_at", 1)
+            for doc in cursor:
+                if doc["_id"] in seen:
+                    continue
+                seen[doc["_id"]] = doc["created_at"]
+                position = max(position, doc["created_at"])
+                self.dispatch(EdgeAdded(doc["user1_id"], doc["user2_id"]))
+
+            seen = {_id: at for _id, at in seen.items() if at >= since}
+            self._save_state({"poll_position": {"created_at": position}}, force=False)
+            self._stop.wait(self.poll_interval)
+
+
+def update_friend_graph(event):
+    """Keep this worker's in-memory graph in step with other workers' writes."""
+    from netwerker.utils.graph import friend_graph
+
+    if isinstance(event, EdgeAdded):
+        # also sees this worker's own writes, add_edge skips those
+        friend_graph.add_edge(event.user1_id, event.user2_id)
+    elif isinstance(event, EdgeRemoved):
+        friend_graph.remove_edge(event.user1_id, event.user2_id)
+    elif isinstance(event, UserRemoved):
+        friend_graph.remove_user(event.user_id)
+
+
+def clear_distance_cache(event):
+    """Drop cached distances without waiting for the graph epoch check."""
+    from netwerker.utils.misc import distance_cache
+
+    distance_cache.clear()
+
+
+def mark_recommendations_dirty(event):
+    """Queue users whose neighborhood changed for the recommendations job."""
+    from netwerker.utils.recommendations import mark_dirty
+
+    if isinstance(event, (EdgeAdded, EdgeRemoved)):
+        mark_dirty(event.user1_id, event.user2_id)
+
+
+graph_sync = GraphSync()
+graph_sync.register(update_friend_graph)
+graph_sync.register(clear_distance_cache)
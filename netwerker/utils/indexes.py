@@ -0,0 +1,186 @@
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+from netwerker.app import logger, mongo
+
+# server error dropping an index another process has just dropped
+INDEX_NOT_FOUND = 27
+
+# Every index the app's queries rely on, by collection. Synced at deploy with
+# `flask db sync-indexes`, or at startup when SYNC_INDEXES is set.
+INDEXES = {
+    "users": [
+        IndexModel([("uuid", ASCENDING)], name="uuid_unique", unique=True),
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+    ],
+    "friends": [
+        IndexModel(
+            [("friendship_hash", ASCENDING)],
+            name="friendship_hash_unique",
+            unique=True,
+        ),
+        # graph snapshot replay
+        IndexModel([("created_at", ASCENDING)], name="created_at"),
+    ],
+    "friend_buckets": [
+        # tail bucket lookup on add, and reading a user's buckets in order
+        IndexModel([("user_id", ASCENDING), ("count", ASCENDING)], name="user_count"),
+        IndexModel([("user_id", ASCENDING), ("_id", ASCENDING)], name="user_buckets"),
+    ],
+}
+
+# Representative query shapes issued by mongo_queries.py, adjacency.py, misc.py,
+# graph.py and routes.py. Values are placeholders, only the shape matters to
+# the planner.
+_oid = ObjectId()
+QUERY_SHAPES = [
+    ("get_user by uuid", "users", {"uuid": "x"}, None),
+    ("get_user by email", "users", {"email": "x@example.com"}, None),
+    ("get_user by _id", "users", {"_id": _oid}, None),
+    ("get_users / get_friend_lists", "users", {"_id": {"$in": [_oid]}}, {"_id": 1}),
+    ("uuids resolved in bulk", "users", {"uuid": {"$in": ["x"]}}, None),
+    ("user import email check", "users", {"email": {"$in": ["x@example.com"]}}, None),
+    ("Users.get page", "users", {"_id": {"$gt": _oid}}, {"_id": 1}),
+    ("UserFriends.post duplicate check", "friends", {"friendship_hash": "1"}, None),
+    (
+        "FriendGraph.replay",
+        "friends",
+        {"created_at": {"$gte": datetime(1970, 1, 1)}},
+        {"created_at": 1},
+    ),
+    (
+        "add_friendships tail bucket",
+        "friend_buckets",
+        {"user_id": _oid, "count": {"$lt": 500}},
+        None,
+    ),
+    (
+        "get_friend_lists buckets",
+        "friend_buckets",
+        {"user_id": {"$in": [_oid]}},
+        {"user_id": 1, "_id": 1},
+    ),
+]
+
+
+def _legacy_index(existing: dict, model: IndexModel):
+    """Name of an existing index on the same keys as ``model`` but another name.
+
+    Mongo refuses a second index on the same keys, such as the unnamed
+    friendship_hash_1 created by older versions of mongo-init.js.
+    """
+    key = list(model.document["key"].items())
+    for name, info in existing.items():
+        if name != model.document["name"] and info["key"] == key:
+            return name
+    return None
+
+
+def _has_duplicates(coll, model: IndexModel):
+    """Whether existing documents would fail a unique build of ``model``."""
+    key = {field.replace(".", "_"): f"${field}" for field in model.document["key"]}
+    duplicates = coll.aggregate(
+        [
+            {"$group": {"_id": key, "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": 1}}},
+            {"$limit": 1},
+        ],
+        allowDiskUse=True,
+    )
+    return next(duplicates, None) is not None
+
+
+def _drop_index(coll, name: str):
+    try:
+        coll.drop_index(name)
+    except OperationFailure as e:
+        # another worker or deploy got there first
+        if e.code != INDEX_NOT_FOUND:
+            raise
+
+
+def sync_indexes():
+    """Create any index in INDEXES that does not exist yet.
+
+    An index with the same keys under another name is replaced, so older
+    deployments pick up the unique constraints. Indexes are built one at a
+    time: a failure, such as a unique index that existing duplicates prevent
+    from being built, is logged and returned rather than raised, and leaves
+    the other indexes alone. A legacy index is only dropped once a check for
+    duplicates shows its unique successor can be built, and is restored if
+    the build still fails.
+
+    Safe to run from several processes at once, though it is meant to run
+    once per deploy with ``flask db sync-indexes``.
+
+    Returns
+    -------
+    failures : list
+        "collection.index" names of the indexes that could not be built
+    """
+    failures = []
+    for collection, indexes in INDEXES.items():
+        coll = mongo.db[collection]
+        existing = coll.index_information()
+        for model in indexes:
+            name = model.document["name"]
+            legacy = _legacy_index(existing, model)
+            if legacy:
+                if model.document.get("unique") and _has_duplicates(coll, model):
+                    # the build would fail, keep the old index until data is fixed
+                    failures.append(f"{collection}.{name}")
+                    logger.error(
+                        f"Index {name} on {collection} not built: duplicate keys,"
+                        f" keeping {legacy}"
+                    )
+                    continue
+                logger.warning(f"Replacing index {legacy} on {collection} with {name}")
+                _drop_index(coll, legacy)
+
+            try:
+                coll.create_indexes([model])
+            except OperationFailure as e:
+                failures.append(f"{collection}.{name}")
+                logger.error(f"Index {name} on {collection} failed to build: {e}")
+                if legacy:
+                    # keep the queries indexed until the data is fixed
+                    coll.create_index(existing[legacy]["key"], name=legacy)
+
+        logger.info(f"Indexes synced for {collection}")
+
+    return failures
+
+
+def _plan_stages(plan):
+    yield plan.get("stage")
+    if "inputStage" in plan:
+        yield from _plan_stages(plan["inputStage"])
+    for child in plan.get("inputStages", []):
+        yield from _plan_stages(child)
+
+
+def check_query_plans():
+    """
+    Explain every query shape in QUERY_SHAPES.
+
+    Returns
+    -------
+    failures : list
+        Names of the query shapes whose winning plan is a collection scan
+    """
+    failures = []
+    for name, collection, query, sort in QUERY_SHAPES:
+        command = {"find": collection, "filter": query}
+        if sort:
+            command["sort"] = sort
+
+        explained = mongo.db.command("explain", command, verbosity="queryPlanner")
+        stages = list(_plan_stages(explained["queryPlanner"]["winningPlan"]))
+        if "COLLSCAN" in stages:
+            failures.append(name)
+        logger.info(f"{name}: {' <- '.join(s for s in stages if s)}")
+
+    return failures
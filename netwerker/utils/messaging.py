@@ -3,7 +3,6 @@ import logging
 import pathlib
 from dataclasses import dataclass
 
-import boto3
 import idna
 from botocore.exceptions import ClientError
 from flask import current_app, render_template
@@ -11,12 +10,19 @@ from flask.json import dumps
 from marshmallow import ValidationError
 from werkzeug.exceptions import BadRequest
 
+from netwerker.utils.blocklist import DomainBlocklist
+from netwerker.utils.email_dispatch import email_dispatcher
+
+_blacklisted_email_domains = None
+
 
 def email_domain_blacklisted(email_address: str):
     """Check whether the domain of an email address is blacklisted.
 
     Loads a list with blacklisted domain names and checks whether or not the
-    provided email address is blacklisted or not. Email address may be
+    provided email address, or any parent domain of it, is blacklisted or
+    not. The list is shared by all workers through a memory mapped file and
+    reloaded when the text file changes. Email address may be
     given in any character set. IDNA (International Domain Names in
     Applications) is supported. Note that there is no return statement
     and this function is meant only to raise a BadRequest exception if needed.
@@ -33,11 +39,14 @@ def email_domain_blacklisted(email_address: str):
     """
     global _blacklisted_email_domains
 
-    if not _blacklisted_email_domains:
+    if _blacklisted_email_domains is None:
         blacklist_file = (
-            pathlib.Path(current_app.static_folder) / "email-domain-blacklist.txt"
+            pathlib.Path(current_app.static_folder) / "email_domains_blacklist.txt"
+        )
+        _blacklisted_email_domains = DomainBlocklist(
+            str(blacklist_file),
+            cache_dir=current_app.config.get("BLOCKLIST_CACHE_DIR"),
         )
-        _blacklisted_email_domains = blacklist_file.read_text().split("\n")
 
     parts = email_address.split("@")
     if len(parts) != 2:
@@ -51,10 +60,79 @@ def email_domain_blacklisted(email_address: str):
     except idna.IDNAError:
         raise BadRequest("Not a valid email address.")
 
-    if domain in _blacklisted_email_domains:
+    if _blacklisted_email_domains.blocked(domain):
         raise BadRequest(f'Email addresses from "{parts[1]}" are not allowed.')
 
 
+def route_recipient(to: str):
+    """Validate a recipient and apply DEV environment routing.
+
+    Raises
+    ------
+    :class:`~werkzeug.exceptions.BadRequest`
+        Raised when the email address is invalid.
+    """
+    domain = to.split("@")
+    if len(domain) != 2:
+        raise BadRequest(f"Email address {to} invalid.")
+
+    # Route emails to AWS mailbox simulator when in DEV environment,
+    # unless domain is in the accepted domains list.
+    if current_app.debug and domain[1] not in ("gmail.com", "netwerker.com"):
+        to = "success@simulator.amazonses.com"
+
+    return to
+
+
+def build_email(
+    template: str,
+    to: str,
+    sender: str = "NeTwerker No Reply <no-reply@netwerker.com>",
+    _internal: str = None,
+    **kwargs,
+):
+    """Render an email into the arguments of an SES send_email call.
+
+    The body text is based on 3 email templates in '/templates':
+    template.html for HTML formatted emails, template.txt for plain text
+    formatted emails, and template-subject.txt for the subject line. Any
+    additional keyword arguments passed in here are used as replacement values
+    when rendering the templates. See :func:`send_email` for the parameters.
+
+    Returns
+    -------
+    message : dict
+        Destination, Message and Source keyword arguments for SES
+    """
+    if _internal:
+        if _internal not in ("success", "bounce", "complaint"):
+            raise BadRequest("Invalid internal address.")
+
+        to = f"{_internal}@simulator.amazonses.com"
+
+    to = route_recipient(to)
+
+    if template.endswith(".html"):
+        template = template[:-5]
+    elif template.endswith(".txt"):
+        template = template[:-4]
+
+    body_html = render_template(f"{template}.html", **kwargs)
+    body_text = render_template(f"{template}.txt", **kwargs)
+    subject = render_template(f"{template}-subject.txt", **kwargs)
+
+    destination = {"ToAddresses": [to]}
+    message = {
+        "Subject": {"Charset": "utf-8", "Data": subject},
+        "Body": {
+            "Html": {"Charset": "utf-8", "Data": body_html},
+            "Text": {"Charset": "utf-8", "Data": body_text},
+        },
+    }
+
+    return {"Destination": destination, "Message": message, "Source": sender}
+
+
 def send_email(
     template: str,
     to: str,
@@ -64,11 +142,13 @@ def send_email(
 ):
     """Send an email.
 
-    Send an email using Amazon SES service. The body text is based on 3 email
-    templates in '/templates': template.html for HTML formatted emails,
-    template.txt for plain text formatted emails, and template-subject.txt for
-    the subject line. Any additional keyword arguments passed in here are
-    used as replacement values when rendering the templates.
+    Send an email using Amazon SES service, waiting for the result. The body
+    text is based on 3 email templates in '/templates': template.html for HTML
+    formatted emails, template.txt for plain text formatted emails, and
+    template-subject.txt for the subject line. Any additional keyword
+    arguments passed in here are used as replacement values when rendering
+    the templates. Use :func:`queue_email` to send from a request without
+    waiting on SES.
 
     Parameters
     ----------
@@ -98,45 +178,12 @@ def send_email(
         Raised when email address is invalid or when email failed to send through
         Amazon SES.
     """
-    if _internal:
-        if _internal not in ("success", "bounce", "complaint"):
-            raise BadRequest("Invalid internal address.")
+    email = build_email(template, to, sender=sender, _internal=_internal, **kwargs)
+    to = email["Destination"]["ToAddresses"][0]
 
-        to = f"{_internal}@simulator.amazonses.com"
-
-    domain = to.split("@")
-    if len(domain) != 2:
-        raise BadRequest(f"Email address {to} invalid.")
-
-    # Route emails to AWS mailbox simulator when in DEV environment,
-    # unless domain is in the accepted domains list.
-    if current_app.debug and domain[1] not in ("gmail.com", "netwerker.com"):
-        to = "success@simulator.amazonses.com"
-
-    if template.endswith(".html"):
-        template = template[:-5]
-    elif template.endswith(".txt"):
-        template = template[:-4]
-
-    body_html = render_template(f"{template}.html", **kwargs)
-    body_text = render_template(f"{template}.txt", **kwargs)
-    subject = render_template(f"{template}-subject.txt", **kwargs)
-
-    destination = {"ToAddresses": [to]}
-    message = {
-        "Subject": {"Charset": "utf-8", "Data": subject},
-        "Body": {
-            "Html": {"Charset": "utf-8", "Data": body_html},
-            "Text": {"Charset": "utf-8", "Data": body_text},
-        },
-    }
-
-    # Create a new SES resource; use default region.
-    client = boto3.client("ses")
+    # The transport holds one SES client for the life of the process.
     try:
-        response = client.send_email(
-            Destination=destination, Message=message, Source=sender
-        )
+        mid = email_dispatcher.transport.send(email)
     except ClientError as err:
         # Log extra info to error log, info we don't want in message to end user.
         msg = err.response["Error"]["Message"]
@@ -146,8 +193,29 @@ def send_email(
         )
         raise BadRequest("Email failed to send.")
     else:
-        mid = response["MessageId"]
         current_app.logger.info(
             f'Email based on template "{template}" sent to "{to}", message ID:'
             f" {mid}"
         )
+
+
+def queue_email(
+    template: str,
+    to: str,
+    sender: str = "NeTwerker No Reply <no-reply@netwerker.com>",
+    _internal: str = None,
+    **kwargs,
+):
+    """Render an email and hand it to the background dispatcher.
+
+    Returns as soon as the message is queued. Delivery, retries and failures
+    are logged by the dispatcher workers. Parameters are the same as
+    :func:`send_email`.
+
+    Raises
+    ------
+    :class:`~werkzeug.exceptions.ServiceUnavailable`
+        Raised when the dispatch queue is full.
+    """
+    email = build_email(template, to, sender=sender, _internal=_internal, **kwargs)
+    email_dispatcher.enqueue(email)
@@ -0,0 +1,358 @@
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from flask import Response, g, has_request_context, request
+from pymongo import monitoring
+
+from netwerker.app import logger
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labels: tuple):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{value}"' for key, value in labels)
+    return "{" + pairs + "}"
+
+
+class Histogram(object):
+    """Prometheus style cumulative histogram, one series per label set."""
+
+    def __init__(self, name: str, help: str, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._series = defaultdict(lambda: [0] * (len(buckets) + 1) + [0.0])
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series[key]
+            # per-bucket counts, made cumulative when rendered
+            series[bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        for key, values in series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), values):
+                cumulative += bucket_count
+                labels = _format_labels(key + (("le", bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {values[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return lines
+
+
+class Counter(object):
+    """Prometheus style counter, one series per label set."""
+
+    def __init__(self, name: str, help: str, type: str = "counter"):
+        self.name = name
+        self.help = help
+        self.type = type
+        self._series = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._series[key] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            for key, value in self._series.items():
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+def _returned_documents(reply: dict):
+    cursor = reply.get("cursor")
+    if cursor:
+        return len(cursor.get("firstBatch", cursor.get("nextBatch", ())))
+    return reply.get("n", 0)
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """
+    Attributes every Mongo command to the Flask request that issued it.
+
+    pymongo publishes command events on the thread running the command, so
+    the request context is the one that made the call. Per request totals
+    are kept on ``g``; process wide totals per route feed the metrics.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def started(self, event):
+        if has_request_context():
+            # remember the collection, succeeded events do not carry it
+            collection = event.command.get(event.command_name)
+            if not isinstance(collection, str):
+                collection = event.database_name
+            g.setdefault("mongo_pending", {})[event.request_id] = collection
+
+    def succeeded(self, event):
+        self._record(event, _returned_documents(event.reply), failed=False)
+
+    def failed(self, event):
+        self._record(event, 0, failed=True)
+
+    def _record(self, event, documents: int, failed: bool):
+        seconds = event.duration_micros / 1e6
+        if has_request_context():
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            collection = g.get("mongo_pending", {}).pop(event.request_id, None)
+            key = (event.command_name, collection)
+            stats = g.setdefault("mongo_commands", {})
+            entry = stats.setdefault(key, [0, 0.0, 0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] += documents
+        else:
+            route = "none"
+
+        labels = {"route": route, "command": event.command_name}
+        self.metrics.mongo_commands.inc(**labels)
+        self.metrics.mongo_seconds.inc(seconds, **labels)
+        self.metrics.mongo_documents.inc(documents, **labels)
+        if failed:
+            self.metrics.mongo_failures.inc(**labels)
+
+
+class PoolListener(monitoring.ConnectionPoolListener):
+    """Measures how long requests wait to check a connection out of the pool."""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self._local = threading.local()
+
+    def connection_check_out_started(self, event):
+        # check out starts and finishes on the same thread
+        self._local.started = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        started = getattr(self._local, "started", None)
+        if started is not None:
+            self.metrics.pool_wait.observe(time.perf_counter() - started)
+            self._local.started = None
+
+    def connection_check_out_failed(self, event):
+        self._local.started = None
+        self.metrics.pool_checkout_failures.inc(reason=event.reason)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+    def connection_checked_in(self, event):
+        pass
+
+
+class Metrics(object):
+    """
+    Request and Mongo metrics exposed at /metrics in Prometheus text format.
+
+    Other modules add their own numbers with :meth:`register_collector`; a
+    collector returns ``(name, type, help, [(labels dict, value), ...])``
+    tuples and is called on every scrape.
+    """
+
+    def __init__(self):
+        self.slow_request_ms = 1000
+        self.request_latency = Histogram(
+            "netwerker_request_seconds", "Request latency by route."
+        )
+        self.mongo_commands = Counter(
+            "netwerker_mongo_commands_total", "Mongo commands by route."
+        )
+        self.mongo_seconds = Counter(
+            "netwerker_mongo_seconds_total", "Time spent in Mongo commands by route."
+        )
+        self.mongo_documents = Counter(
+            "netwerker_mongo_documents_total", "Documents returned by Mongo by route."
+        )
+        self.mongo_failures = Counter(
+            "netwerker_mongo_failures_total", "Failed Mongo commands by route."
+        )
+        self.pool_wait = Histogram(
+            "netwerker_mongo_pool_wait_seconds",
+            "Time spent waiting to check out a Mongo connection.",
+            buckets=(0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0),
+        )
+        self.pool_checkout_failures = Counter(
+            "netwerker_mongo_pool_checkout_failures_total",
+            "Failed Mongo connection check outs by reason.",
+        )
+        self.listener = MongoCommandListener(self)
+        self.pool_listener = PoolListener(self)
+        self._collectors = []
+
+    def init_app(self, app):
+        self.slow_request_ms = app.config.get("SLOW_REQUEST_MS", self.slow_request_ms)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.add_url_rule("/metrics", "metrics", self.render_response)
+        self.register_collector(app_collector)
+
+    def register_collector(self, collector):
+        self._collectors.append(collector)
+
+    def _before_request(self):
+        g.request_started = time.perf_counter()
+
+    def _after_request(self, response):
+        started = g.get("request_started")
+        if started is None:
+            return response
+
+        seconds = time.perf_counter() - started
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        self.request_latency.observe(
+            seconds, route=route, method=request.method, status=response.status_code
+        )
+
+        if seconds * 1000 >= self.slow_request_ms:
+            commands = g.get("mongo_commands", {})
+            breakdown = ", ".join(
+                f"{command} {collection} x{count} {total * 1000:.1f}ms {docs} docs"
+                for (command, collection), (count, total, docs) in commands.items()
+            )
+            logger.warning(
+                f"Slow request {request.method} {request.full_path}"
+                f" {seconds * 1000:.0f}ms; mongo: {breakdown or 'none'}"
+            )
+
+        return response
+
+    def render(self):
+        lines = []
+        for metric in (
+            self.request_latency,
+            self.mongo_commands,
+            self.mongo_seconds,
+            self.mongo_documents,
+            self.mongo_failures,
+            self.pool_wait,
+            self.pool_checkout_failures,
+        ):
+            lines.extend(metric.render())
+
+        for collector in self._collectors:
+            for name, type, help, samples in collector():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {type}")
+                for labels, value in samples:
+                    lines.append(
+                        f"{name}{_format_labels(tuple(sorted(labels.items())))} {value}"
+                    )
+
+        return "\n".join(lines) + "\n"
+
+    def render_response(self):
+        return Response(self.render(), mimetype="text/plain; version=0.0.4")
+
+
+def app_collector():
+    """Numbers kept by the app's caches, pools and graph searches."""
+    from netwerker.utils.auth import token_auth
+    from netwerker.utils.email_dispatch import email_dispatcher
+    from netwerker.utils.graph import friend_graph
+    from netwerker.utils.graph_sync import graph_sync
+    from netwerker.utils.misc import distance_cache, search_budget_hits
+    from netwerker.utils.passwords import password_hasher
+
+    caches = {"distance": distance_cache.stats(), "token": token_auth.cache.stats()}
+    hasher = password_hasher.stats()
+
+    yield (
+        "netwerker_cache_hits_total",
+        "counter",
+        "Cache hits.",
+        [({"cache": name}, stats["hits"]) for name, stats in caches.items()],
+    )
+    yield (
+        "netwerker_cache_misses_total",
+        "counter",
+        "Cache misses.",
+        [({"cache": name}, stats["misses"]) for name, stats in caches.items()],
+    )
+    yield (
+        "netwerker_search_budget_exhausted_total",
+        "counter",
+        "Graph searches stopped by a budget.",
+        [({"budget": name}, count) for name, count in search_budget_hits.items()],
+    )
+    yield (
+        "netwerker_password_hash_seconds_total",
+        "counter",
+        "Time spent hashing and verifying passwords.",
+        [({}, hasher["total_seconds"])],
+    )
+    yield (
+        "netwerker_password_hash_total",
+        "counter",
+        "Password hashes and verifications.",
+        [({}, hasher["calls"])],
+    )
+    yield (
+        "netwerker_password_queue_depth",
+        "gauge",
+        "Password jobs waiting or running.",
+        [({}, hasher["queue_depth"])],
+    )
+    yield (
+        "netwerker_email_total",
+        "counter",
+        "Emails by dispatch outcome.",
+        [({"outcome": k}, v) for k, v in email_dispatcher.stats().items()],
+    )
+    yield (
+        "netwerker_graph_sync_total",
+        "counter",
+        "Graph sync events, consumer failures and restarts.",
+        [({"kind": k}, v) for k, v in graph_sync.stats.items()],
+    )
+    if friend_graph.loaded:
+        usage = friend_graph.memory_usage()
+        yield (
+            "netwerker_graph_bytes",
+            "gauge",
+            "Memory held by the in-memory friend graph.",
+            [({}, usage["total_bytes"])],
+        )
+        yield (
+            "netwerker_graph_mapped_bytes",
+            "gauge",
+            "Size of the graph snapshot mapped and shared between workers.",
+            [({}, usage["mapped_bytes"])],
+        )
+
+
+metrics = Metrics()
@@ -1,10 +1,18 @@
-from collections import deque
+import time
+from bisect import bisect_right
+from collections import Counter
+from datetime import datetime
+from uuid import uuid4
 
 import xxhash
 from bson import ObjectId
+from flask import Response, stream_with_context
+from flask.json import dumps
 
 from netwerker.app import mongo
-from netwerker.utils.mongo_queries import get_user
+from netwerker.utils.adjacency import get_friend_lists
+from netwerker.utils.cache import TTLCache
+from netwerker.utils.graph import friend_graph
 
 
 def generate_friendship_hash(_id_1: str, _id_2: str):
@@ -15,39 +23,604 @@ def generate_friendship_hash(_id_1: str, _id_2: str):
     return str(xxhash.xxh64_intdigest(concatenated_ids))
 
 
-def bfs_friendship_distance(start_user_id: str, target_user_id: str):
-    """ BFS to find distance between two users via their friends. 
-    Optimization done by checking bi-directional friendships and indexed friendship hashes
-    using the friendship_hash field in the friends collection."""
-    queue = deque(
-        [(start_user_id, 0)]
-    )  # Each entry is (user_id (BSON ObjectId, but cast as string), distance)
-    visited = set()
-    while queue:
-        current_user_id, current_distance = queue.popleft()
+# distance results keyed by (friendship hash, graph epoch)
+distance_cache = TTLCache(maxsize=100_000, ttl=300)
+_MISSING = object()
 
-        # Skip if this user is already visited
-        if current_user_id in visited:
-            continue
 
-        visited.add(current_user_id)  # Mark the user as visited
+def get_graph_epoch():
+    """Current graph epoch, shared by every worker through Mongo."""
+    doc = mongo.db.counters.find_one({"_id": "graph_epoch"})
+    return doc["value"] if doc else 0
 
-        # Generate the hash for the current user and target user
-        friendship_hash = generate_friendship_hash(current_user_id, target_user_id)
 
-        # Check if the current user and target user are direct friends
-        if mongo.db.friends.find_one({"friendship_hash": friendship_hash}):
-            return current_distance + 1
+def bump_graph_epoch():
+    """Invalidate every cached graph result. Call after any friendship change."""
+    mongo.db.counters.update_one(
+        {"_id": "graph_epoch"}, {"$inc": {"value": 1}}, upsert=True
+    )
 
-        # Fetch the current user's friends from MongoDB
-        current_user = get_user(_id=ObjectId(current_user_id), get_friends=True)
-        if not current_user or "friends" not in current_user:
-            continue
 
-        friends = current_user["friends"]
+def cached_friendship_distance(start_user_id: str, target_user_id: str, **budgets):
+    """bfs_friendship_distance behind a cache invalidated by the graph epoch.
 
-        for friend_id in friends:
-            if friend_id not in visited:
-                queue.append((str(friend_id), current_distance + 1))
+    The epoch is part of the cache key, so once any worker bumps it every
+    worker stops seeing older results; they age out of the LRU on their own.
+    The epoch is read from the primary, so the search does too: a lagging
+    secondary would get an old graph cached under the new epoch. Searches
+    that run out of budget raise and are not cached. A cached distance
+    beyond the caller's max_depth raises as the search would have.
+    """
+    key = (generate_friendship_hash(start_user_id, target_user_id), get_graph_epoch())
+
+    distance = distance_cache.get(key, _MISSING)
+    if distance is _MISSING:
+        distance = bfs_friendship_distance(
+            start_user_id, target_user_id, primary=True, **budgets
+        )
+        distance_cache.set(key, distance)
+
+    return within_depth(distance, budgets.get("max_depth"))
+
+
+def friendship_document(_id_1: ObjectId, _id_2: ObjectId):
+    """Build the friends collection document for a new friendship."""
+    sorted_ids = sorted([_id_1, _id_2])
+
+    return {
+        "friendship_hash": generate_friendship_hash(str(_id_1), str(_id_2)),
+        "user1_id": sorted_ids[0],
+        "user2_id": sorted_ids[1],
+        "created_at": datetime.utcnow(),
+    }
+
+
+def user_document(data: dict, password_hash: str):
+    """Build the users collection document for a new user from UserSchema data."""
+    doc = {key: value for key, value in data.items() if key != "password"}
+    doc["passwordHash"] = password_hash
+    doc["uuid"] = str(uuid4())
+    doc["email"] = data["email"].lower()
+    # TODO: set to False and send email to user to verify email address
+    doc["email_verified"] = True
+
+    return doc
+
+
+def paginate_ids(sorted_ids: list, limit: int, after: ObjectId = None):
+    """Keyset pagination over a sorted list of ObjectIds.
+
+    Returns
+    -------
+    page : tuple
+        The ids on this page and the cursor for the next page (None on the last)
+    """
+    start = bisect_right(sorted_ids, after) if after else 0
+    page_ids = sorted_ids[start : start + limit]
+
+    next_cursor = None
+    if start + limit < len(sorted_ids):
+        next_cursor = str(page_ids[-1])
+
+    return page_ids, next_cursor
+
+
+def mutual_friends(friends_1: list, friends_2: list):
+    """Sorted ObjectIds present in both friends arrays.
+
+    Only the smaller array is hashed; the larger one is streamed through it.
+    """
+    if len(friends_1) > len(friends_2):
+        friends_1, friends_2 = friends_2, friends_1
+    smaller = set(friends_1)
+
+    return sorted(friend_id for friend_id in friends_2 if friend_id in smaller)
+
+
+def stream_documents(cursor, fmt: str = "ndjson"):
+    """Stream documents from a Mongo cursor as they arrive.
+
+    Memory use stays constant regardless of how many documents the cursor
+    returns; the first byte is sent as soon as the first batch is read.
+
+    Parameters
+    ----------
+    cursor : pymongo.cursor.Cursor
+        Cursor to drain. Documents must be JSON serializable.
+    fmt : str
+        "ndjson" for one document per line, "array" for a chunked JSON array
+
+    Returns
+    -------
+    response : flask.Response
+        Streaming response
+    """
+
+    def generate():
+        if fmt == "ndjson":
+            for doc in cursor:
+                yield dumps(doc) + "\n"
+            return
+
+        yield "["
+        for i, doc in enumerate(cursor):
+            yield ("," if i else "") + dumps(doc)
+        yield "]"
+
+    mimetype = "application/x-ndjson" if fmt == "ndjson" else "application/json"
+
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+
+class SearchBudgetExceeded(Exception):
+    """Raised when a graph search runs out of budget before finishing.
+
+    Attributes
+    ----------
+    budget : str
+        The budget that ran out: "max_depth", "max_nodes" or "deadline"
+    farther_than : int
+        The users are known to be more than this many hops apart. 0 means
+        nothing is known.
+    """
+
+    def __init__(self, budget: str, farther_than: int):
+        super().__init__(f"{budget} budget exhausted after {farther_than} hops")
+        self.budget = budget
+        self.farther_than = farther_than
+
+    def known(self):
+        """What is known about the distance, as returned by the API."""
+        if self.farther_than:
+            return {"farther_than": self.farther_than}
+        return {"unknown": True}
+
+
+# how often each search budget has run out, by budget name
+search_budget_hits = Counter()
+
+
+def within_depth(distance, max_depth=None):
+    """A cached distance, checked against the max_depth of the current caller.
+
+    Raises SearchBudgetExceeded as a search limited to ``max_depth`` would
+    when the users are farther apart than that.
+    """
+    if distance is not None and max_depth is not None and distance > max_depth:
+        raise SearchBudgetExceeded("max_depth", max_depth)
+    return distance
+
+
+def _check_budgets(
+    searched, expanded, frontier, max_depth=None, max_nodes=None, deadline=None
+):
+    """Raise SearchBudgetExceeded if the next level may not be expanded.
+
+    ``searched`` is how many hops are known to separate the ends so far,
+    ``expanded`` how many users were expanded before ``frontier``.
+    """
+    budget = None
+    if max_depth is not None and searched >= max_depth:
+        budget = "max_depth"
+    elif max_nodes is not None and expanded + len(frontier) > max_nodes:
+        budget = "max_nodes"
+    elif deadline is not None and time.monotonic() >= deadline:
+        budget = "deadline"
+    if budget:
+        search_budget_hits[budget] += 1
+        raise SearchBudgetExceeded(budget, searched)
+
+
+def _deadline(deadline_ms):
+    """time.monotonic() value of a deadline in milliseconds from now."""
+    return None if deadline_ms is None else time.monotonic() + deadline_ms / 1000
+
+
+def bidirectional_distance_search(
+    start, target, max_depth=None, max_nodes=None, deadline=None
+):
+    """Meet-in-the-middle BFS growing whole levels from both ends.
+
+    The search does no I/O itself: it is a generator that yields each frontier
+    to expand and expects {node: friends} for it to be sent back, so sync and
+    async callers can drive it with their own driver. The distance (or None)
+    is the generator's return value. Budgets are checked before each level is
+    expanded; ``deadline`` is a time.monotonic() value.
+    """
+    if start == target:
+        return 0
+
+    # distance from each end for every user reached so far
+    forward = {start: 0}
+    backward = {target: 0}
+    forward_frontier = [start]
+    backward_frontier = [target]
+    forward_depth = backward_depth = 0
+    expanded = 0
+
+    while forward_frontier and backward_frontier:
+        # expand the cheaper side
+        expand_forward = len(forward_frontier) <= len(backward_frontier)
+        frontier = forward_frontier if expand_forward else backward_frontier
+
+        # every pair closer than the levels searched so far would have met
+        _check_budgets(
+            forward_depth + backward_depth,
+            expanded,
+            frontier,
+            max_depth,
+            max_nodes,
+            deadline,
+        )
+
+        expanded += len(frontier)
+        if expand_forward:
+            seen, other = forward, backward
+            forward_depth += 1
+            depth = forward_depth
+        else:
+            seen, other = backward, forward
+            backward_depth += 1
+            depth = backward_depth
+
+        best = None
+        next_frontier = []
+        expanded_level = yield frontier
+        for friends in expanded_level.values():
+            for friend_id in friends:
+                if friend_id in other:
+                    # frontiers met, keep the shortest crossing on this level
+                    distance = depth + other[friend_id]
+                    if best is None or distance < best:
+                        best = distance
+                if friend_id not in seen:
+                    seen[friend_id] = depth
+                    next_frontier.append(friend_id)
+
+        if best is not None:
+            return best
+
+        if expand_forward:
+            forward_frontier = next_frontier
+        else:
+            backward_frontier = next_frontier
 
     return None  # No path found
+
+
+def _run_search(search, expand):
+    """Drive an I/O-free search generator with a blocking ``expand``."""
+    try:
+        frontier = next(search)
+        while True:
+            frontier = search.send(expand(frontier))
+    except StopIteration as done:
+        return done.value
+
+
+def bfs_friendship_distance(
+    start_user_id: str,
+    target_user_id: str,
+    max_depth: int = None,
+    max_nodes: int = None,
+    deadline_ms: int = None,
+    primary: bool = False,
+):
+    """Bidirectional BFS to find the distance between two users via their friends.
+
+    The search grows one whole level at a time from both ends, always expanding
+    the smaller frontier. Each level is fetched with a single ``$in`` query, so
+    the number of round trips is proportional to the distance rather than to
+    the number of users visited. The search stops as soon as the two frontiers
+    meet.
+
+    When the in-memory graph engine is enabled the search runs against it
+    instead and no queries are made.
+
+    Parameters
+    ----------
+    start_user_id : str
+        ObjectId of the first user, cast as a string
+    target_user_id : str
+        ObjectId of the second user, cast as a string
+    max_depth : int (optional)
+        Give up once the users are known to be more than this many hops apart
+    max_nodes : int (optional)
+        Give up before expanding more than this many users
+    deadline_ms : int (optional)
+        Give up once this many milliseconds have passed
+    primary : bool (optional)
+        Read friend lists from the primary, see :func:`get_friend_lists`, or
+        catch the in-memory graph up to the current graph epoch first
+
+    Returns
+    -------
+    distance : int
+        Number of hops between the two users, or None if they are not connected
+
+    Raises
+    ------
+    SearchBudgetExceeded
+        Raised when a budget runs out before the search finishes.
+    """
+    start_id, target_id = ObjectId(start_user_id), ObjectId(target_user_id)
+    if start_id == target_id:
+        return 0
+
+    budgets = {
+        "max_depth": max_depth,
+        "max_nodes": max_nodes,
+        "deadline": _deadline(deadline_ms),
+    }
+
+    # answer from the in-memory graph when the engine is enabled
+    if friend_graph.ensure_loaded():
+        if primary:
+            # as fresh as a primary read: add friendships not yet synced
+            friend_graph.catch_up(get_graph_epoch())
+        start, target = friend_graph.node_id(start_id), friend_graph.node_id(target_id)
+        if start is None or target is None:
+            return None
+        return _run_search(
+            bidirectional_distance_search(start, target, **budgets),
+            lambda frontier: {n: friend_graph.friends_of(n) for n in frontier},
+        )
+
+    return _run_search(
+        bidirectional_distance_search(start_id, target_id, **budgets),
+        lambda frontier: get_friend_lists(frontier, primary=primary),
+    )
+
+
+def level_distance_search(
+    source, targets: set, max_depth=None, max_nodes=None, deadline=None
+):
+    """Level-synchronous BFS recording the depth at which each target is reached.
+
+    Driven like :func:`bidirectional_distance_search`, whose budgets it
+    shares: it yields each frontier and expects {node: friends} for it back.
+
+    Returns
+    -------
+    result : tuple
+        {target: depth} for the targets reached, and the SearchBudgetExceeded
+        that stopped the search early or None
+    """
+    found = {}
+    if source in targets:
+        found[source] = 0
+
+    seen = {source}
+    frontier = [source]
+    depth = expanded = 0
+    while frontier and len(found) < len(targets):
+        try:
+            _check_budgets(depth, expanded, frontier, max_depth, max_nodes, deadline)
+        except SearchBudgetExceeded as e:
+            # targets reached so far are exact, the rest are farther away
+            return found, e
+
+        expanded += len(frontier)
+        depth += 1
+        next_frontier = []
+        expanded_level = yield frontier
+        for friends in expanded_level.values():
+            for friend_id in friends:
+                if friend_id in seen:
+                    continue
+                seen.add(friend_id)
+                next_frontier.append(friend_id)
+                if friend_id in targets:
+                    found[friend_id] = depth
+        frontier = next_frontier
+
+    return found, None
+
+
+def bfs_distances(
+    start_user_id: ObjectId,
+    target_user_ids,
+    max_depth: int = None,
+    max_nodes: int = None,
+    deadline_ms: int = None,
+):
+    """Distances from one user to many, from a single search.
+
+    One BFS grows from the start user a level at a time, each level fetched
+    with one ``$in`` query (or read from the in-memory graph when enabled).
+    It stops once every target has been reached or a budget runs out.
+
+    Parameters
+    ----------
+    start_user_id : ObjectId
+        User to measure from
+    target_user_ids : iterable of ObjectId
+        Users to measure to
+    max_depth : int (optional)
+        Deepest level searched
+    max_nodes : int (optional)
+        Give up before expanding more than this many users
+    deadline_ms : int (optional)
+        Give up once this many milliseconds have passed
+
+    Returns
+    -------
+    result : tuple
+        A dict mapping each target ObjectId to its distance, or None if it
+        was not reached, and the SearchBudgetExceeded that stopped the search
+        (None if it finished). When the search stopped early, every target
+        that was not reached is more than ``farther_than`` hops away.
+    """
+    targets = set(target_user_ids)
+    budgets = {
+        "max_depth": max_depth,
+        "max_nodes": max_nodes,
+        "deadline": _deadline(deadline_ms),
+    }
+    exceeded = None
+
+    if friend_graph.ensure_loaded():
+        dense = {friend_graph.node_id(_id): _id for _id in targets}
+        dense.pop(None, None)
+        source = friend_graph.node_id(start_user_id)
+        found = {}
+        if source is not None:
+            found, exceeded = _run_search(
+                level_distance_search(source, set(dense), **budgets),
+                lambda frontier: {n: friend_graph.friends_of(n) for n in frontier},
+            )
+        found = {dense[node]: depth for node, depth in found.items()}
+    else:
+        found, exceeded = _run_search(
+            level_distance_search(start_user_id, targets, **budgets),
+            get_friend_lists,
+        )
+
+    return {_id: found.get(_id) for _id in targets}, exceeded
+
+
+def _paths_to(node, parents: dict, limit: int):
+    """Up to ``limit`` paths from the search root to node, root first."""
+    if node not in parents:
+        return [[node]]
+
+    paths = []
+    for parent in parents[node]:
+        for path in _paths_to(parent, parents, limit - len(paths)):
+            paths.append(path + [node])
+            if len(paths) == limit:
+                return paths
+    return paths
+
+
+def bidirectional_paths_search(
+    start, target, k: int, max_depth=None, max_nodes=None, deadline=None
+):
+    """Meet-in-the-middle BFS returning up to k shortest paths.
+
+    Each side keeps, for every node it reaches, the nodes on the previous level
+    it was reached from (only the first when k is 1). Driven like
+    :func:`bidirectional_distance_search`, whose budgets it shares.
+    """
+    if start == target:
+        return [[start]]
+
+    forward, backward = {start: 0}, {target: 0}
+    forward_parents, backward_parents = {}, {}
+    forward_frontier, backward_frontier = [start], [target]
+    forward_depth = backward_depth = 0
+    expanded = 0
+
+    while forward_frontier and backward_frontier:
+        expand_forward = len(forward_frontier) <= len(backward_frontier)
+        _check_budgets(
+            forward_depth + backward_depth,
+            expanded,
+            forward_frontier if expand_forward else backward_frontier,
+            max_depth,
+            max_nodes,
+            deadline,
+        )
+        if expand_forward:
+            frontier, seen, other = forward_frontier, forward, backward
+            parents = forward_parents
+            forward_depth += 1
+            depth = forward_depth
+        else:
+            frontier, seen, other = backward_frontier, backward, forward
+            parents = backward_parents
+            backward_depth += 1
+            depth = backward_depth
+        expanded += len(frontier)
+
+        best = None
+        meetings = []  # (node, friend) edges crossing to the other side
+        next_frontier = []
+        expanded_level = yield frontier
+        for node, friends in expanded_level.items():
+            for friend_id in friends:
+                if friend_id in other:
+                    distance = depth + other[friend_id]
+                    if best is None or distance < best:
+                        best, meetings = distance, []
+                    if distance == best:
+                        meetings.append((node, friend_id))
+                if friend_id not in seen:
+                    seen[friend_id] = depth
+                    parents[friend_id] = [node]
+                    next_frontier.append(friend_id)
+                elif k > 1 and seen[friend_id] == depth:
+                    parents[friend_id].append(node)
+
+        if best is not None:
+            paths = []
+            for node, friend_id in meetings:
+                if expand_forward:
+                    heads = _paths_to(node, forward_parents, k)
+                    tails = _paths_to(friend_id, backward_parents, k)
+                else:
+                    heads = _paths_to(friend_id, forward_parents, k)
+                    tails = _paths_to(node, backward_parents, k)
+                for head in heads:
+                    for tail in tails:
+                        paths.append(head + tail[::-1])
+                        if len(paths) == k:
+                            return paths
+            return paths
+
+        if expand_forward:
+            forward_frontier = next_frontier
+        else:
+            backward_frontier = next_frontier
+
+    return []
+
+
+def shortest_friendship_paths(
+    start_user_id: ObjectId,
+    target_user_id: ObjectId,
+    k: int,
+    max_depth: int = None,
+    max_nodes: int = None,
+    deadline_ms: int = None,
+):
+    """Up to k shortest chains of friends connecting two users.
+
+    Uses the same frontier-batched bidirectional search as
+    :func:`bfs_friendship_distance`, with the same budgets, keeping parent
+    pointers so paths can be rebuilt where the frontiers meet. All returned
+    paths have the shortest length; fewer than k are returned when fewer
+    exist.
+
+    Returns
+    -------
+    paths : list of list of ObjectId
+        Each path runs from start_user_id to target_user_id. Empty when the
+        users are not connected.
+
+    Raises
+    ------
+    SearchBudgetExceeded
+        Raised when a budget runs out before the search finishes.
+    """
+    budgets = {
+        "max_depth": max_depth,
+        "max_nodes": max_nodes,
+        "deadline": _deadline(deadline_ms),
+    }
+    if not friend_graph.ensure_loaded():
+        return _run_search(
+            bidirectional_paths_search(start_user_id, target_user_id, k, **budgets),
+            get_friend_lists,
+        )
+
+    start = friend_graph.node_id(start_user_id)
+    target = friend_graph.node_id(target_user_id)
+    if start is None or target is None:
+        return [[start_user_id]] if start_user_id == target_user_id else []
+
+    paths = _run_search(
+        bidirectional_paths_search(start, target, k, **budgets),
+        lambda frontier: {n: friend_graph.friends_of(n) for n in frontier},
+    )
+    return [[friend_graph.user_id(node) for node in path] for path in paths]
@@ -1,7 +1,31 @@
+from flask import current_app
+from pymongo.read_preferences import ReadPreference
 from werkzeug.exceptions import BadRequest, Forbidden
 
 from netwerker.app import mongo
 
+READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+
+# fields needed to dump a user with UserSchema
+USER_SUMMARY_PROJECTION = {"name": 1, "email": 1, "uuid": 1}
+
+
+def bulk_read(collection: str):
+    """
+    Collection handle for read heavy queries that can tolerate replication lag.
+
+    Reads through it follow MONGO_BULK_READ_PREFERENCE, so listings and graph
+    traversals can be served by secondaries while writes stay on the primary.
+    """
+    mode = READ_PREFERENCES[current_app.config["MONGO_BULK_READ_PREFERENCE"]]
+    return mongo.db.get_collection(collection, read_preference=mode)
+
 
 def get_user(
     _id=None,
@@ -9,6 +33,7 @@ def get_user(
     email: str = None,
     none_on_fail: bool = False,
     get_friends: bool = False,
+    bulk: bool = False,
 ):
     """
     Get user by uuid or email.
@@ -21,6 +46,10 @@ def get_user(
         User email
     none_on_fail: bool
         Return None if no user is found when set to True
+    get_friends: bool
+        Include the friends array when set to True
+    bulk: bool
+        Read with the bulk read preference, see :func:`bulk_read`
 
     Returns
     -------
@@ -38,7 +67,8 @@ def get_user(
 
     proj = {"friends": 0} if not get_friends else {}
     try:
-        user = mongo.db.users.find_one(match_query, projection=proj)
+        users = bulk_read("users") if bulk else mongo.db.users
+        user = users.find_one(match_query, projection=proj)
     except Exception as e:
         if none_on_fail:
             return None
@@ -49,3 +79,24 @@ def get_user(
         raise Forbidden("Invalid User")
 
     return user
+
+
+def get_users(_ids, projection: dict = USER_SUMMARY_PROJECTION):
+    """
+    Get many users by ObjectId with a single query.
+
+    Parameters
+    ----------
+    _ids : iterable of ObjectId
+        User ObjectIds to fetch
+    projection : dict
+        Fields to return, the UserSchema fields by default
+
+    Returns
+    -------
+    users : list
+        User documents sorted by _id. Ids that do not exist are skipped.
+    """
+    return list(
+        bulk_read("users").find({"_id": {"$in": list(_ids)}}, projection).sort("_id", 1)
+    )
@@ -0,0 +1,173 @@
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from netwerker.app import logger
+
+
+class PasswordHasher(object):
+    """
+    Runs password hashing and verification in a process pool.
+
+    PBKDF2 is CPU bound, so running it on the request thread holds the worker
+    for the whole computation. Here the work is handed to a pool of processes
+    and the number of jobs waiting or running is capped; when the cap is
+    reached a request waits at most ``queue_timeout`` seconds before it is
+    turned away with a 503.
+
+    With ``pool_size`` set to 0 hashing runs inline on the calling thread.
+    """
+
+    def __init__(
+        self,
+        method: str = "pbkdf2:sha256:260000",
+        pool_size: int = 0,
+        max_queue: int = 64,
+        queue_timeout: float = 5.0,
+    ):
+        self.method = method
+        self.pool_size = pool_size
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._executor = None
+        self._prefix = None
+        self._slots = threading.BoundedSemaphore(max_queue)
+        self._lock = threading.Lock()
+        self._depth = 0
+        self._metrics = {
+            "calls": 0,
+            "rejected": 0,
+            "total_seconds": 0.0,
+            "max_seconds": 0.0,
+        }
+
+    def init_app(self, app):
+        self.method = app.config.get("PASSWORD_HASH_METHOD", self.method)
+        self._prefix = None
+        self.pool_size = app.config.get("PASSWORD_POOL_SIZE", self.pool_size)
+        self.max_queue = app.config.get("PASSWORD_MAX_QUEUE", self.max_queue)
+        self.queue_timeout = app.config.get(
+            "PASSWORD_QUEUE_TIMEOUT", self.queue_timeout
+        )
+        self._slots = threading.BoundedSemaphore(self.max_queue)
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            with self._lock:
+                self._metrics["rejected"] += 1
+            raise ServiceUnavailable("Too many password requests, try again later")
+
+        with self._lock:
+            self._depth += 1
+        started = time.perf_counter()
+        try:
+            if self.pool_size > 0:
+                return self._get_executor().submit(fn, *args).result()
+            return fn(*args)
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self._depth -= 1
+                self._metrics["calls"] += 1
+                self._metrics["total_seconds"] += elapsed
+                self._metrics["max_seconds"] = max(
+                    self._metrics["max_seconds"], elapsed
+                )
+            self._slots.release()
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(max_workers=self.pool_size)
+        return self._executor
+
+    def hash(self, password: str):
+        """Hash a password with the configured method."""
+        return self._run(generate_password_hash, password, self.method)
+
+    def hash_many(self, passwords: list, executor=None):
+        """
+        Hash a batch of passwords, spread over a process pool.
+
+        Parameters
+        ----------
+        passwords : list of str
+            Passwords to hash with the configured method
+        executor : ProcessPoolExecutor
+            Pool to use instead of the hasher's own, e.g. a larger one owned
+            by a bulk import. Without either the batch is hashed inline.
+
+        Returns
+        -------
+        hashes : list of str
+            One hash per password, in order
+        """
+        if executor is None and self.pool_size > 0:
+            executor = self._get_executor()
+
+        started = time.perf_counter()
+        methods = [self.method] * len(passwords)
+        if executor is None:
+            hashes = list(map(generate_password_hash, passwords, methods))
+        else:
+            # large chunks keep the per-task pickling overhead down
+            workers = getattr(executor, "_max_workers", None) or 1
+            chunksize = max(1, len(passwords) // (4 * workers))
+            hashes = list(
+                executor.map(
+                    generate_password_hash, passwords, methods, chunksize=chunksize
+                )
+            )
+
+        with self._lock:
+            self._metrics["calls"] += len(passwords)
+            self._metrics["total_seconds"] += time.perf_counter() - started
+        return hashes
+
+    def verify(self, pwhash: str, password: str):
+        """
+        Check a password against its stored hash.
+
+        Returns
+        -------
+        result : tuple
+            (valid, new_hash). new_hash is a fresh hash of the password when it
+            is valid but was stored with different cost parameters than the
+            configured method, otherwise None.
+        """
+        if not pwhash or not self._run(check_password_hash, pwhash, password):
+            return False, None
+
+        if self.needs_rehash(pwhash):
+            return True, self.hash(password)
+
+        return True, None
+
+    def needs_rehash(self, pwhash: str):
+        # werkzeug fills in defaults, "pbkdf2:sha256" is stored as
+        # "pbkdf2:sha256:<iterations>", so compare with what it actually writes
+        if self._prefix is None:
+            self._prefix = self.hash("").split("$", 1)[0]
+        return pwhash.split("$", 1)[0] != self._prefix
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._metrics)
+            stats["queue_depth"] = self._depth
+        stats["avg_seconds"] = (
+            stats["total_seconds"] / stats["calls"] if stats["calls"] else 0.0
+        )
+        return stats
+
+    def shutdown(self):
+        if self._executor is not None:
+            logger.info("Shutting down password hashing pool")
+            self._executor.shutdown()
+            self._executor = None
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,215 @@
+import heapq
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+
+from flask import current_app
+from pymongo import DeleteOne, ReplaceOne, UpdateOne
+
+from netwerker.app import logger, mongo
+from netwerker.utils.adjacency import get_friend_lists
+from netwerker.utils.bulk import batched
+from netwerker.utils.mongo_queries import get_users
+
+
+def top_candidates(user_id, friends, friend_lists: dict, k: int):
+    """
+    Rank a user's two-hop neighbors by mutual friend count.
+
+    Parameters
+    ----------
+    user_id : ObjectId
+        User to recommend for
+    friends : list of ObjectId
+        The user's friends
+    friend_lists : dict
+        Friends of each of the user's friends, as returned by get_friend_lists
+    k : int
+        Number of candidates to keep
+
+    Returns
+    -------
+    candidates : list of tuple
+        (ObjectId, mutual friend count), best first
+    """
+    exclude = set(friends)
+    exclude.add(user_id)
+
+    counts = Counter()
+    for friend_id in friends:
+        counts.update(
+            candidate
+            for candidate in friend_lists.get(friend_id, ())
+            if candidate not in exclude
+        )
+
+    # ties broken by ObjectId so results are stable between runs
+    return heapq.nlargest(k, counts.items(), key=lambda item: (item[1], item[0]))
+
+
+def _refresh_batch(user_ids, k: int):
+    """Recompute and store recommendations for one batch of users."""
+    friends_by_user = get_friend_lists(user_ids)
+    two_hop = get_friend_lists(
+        {friend_id for friends in friends_by_user.values() for friend_id in friends}
+    )
+
+    # users left without friends get an empty list, replacing stale candidates
+    ranked = {
+        user_id: top_candidates(user_id, friends_by_user.get(user_id, []), two_hop, k)
+        for user_id in user_ids
+    }
+
+    # resolve everything the batch will display with one query
+    summaries = {
+        user["_id"]: user
+        for user in get_users(
+            {candidate for ranking in ranked.values() for candidate, _ in ranking}
+            | set(ranked)
+        )
+    }
+
+    now = datetime.utcnow()
+    writes = []
+    for user_id, ranking in ranked.items():
+        if user_id not in summaries:
+            continue
+        candidates = [
+            {
+                "uuid": summaries[candidate]["uuid"],
+                "name": summaries[candidate].get("name"),
+                "mutual_friends": mutual,
+            }
+            for candidate, mutual in ranking
+            if candidate in summaries
+        ]
+        # keyed by uuid so the endpoint is a single _id lookup
+        uuid = summaries[user_id]["uuid"]
+        writes.append(
+            ReplaceOne(
+                {"_id": uuid},
+                {"_id": uuid, "candidates": candidates, "updated_at": now},
+                upsert=True,
+            )
+        )
+
+    if writes:
+        mongo.db.recommendations.bulk_write(writes, ordered=False)
+
+    return len(writes)
+
+
+def refresh_recommendations(user_ids, k=20, batch_size=500, workers=4):
+    """
+    Precompute the top-k "people you may know" for many users.
+
+    Users are processed in batches, each batch costing three reads and one
+    unordered bulk write, and batches run concurrently on a thread pool. At
+    most ``workers * 2`` batches are read ahead of the pool, so a lazy
+    ``user_ids`` cursor is never drained into memory.
+
+    Parameters
+    ----------
+    user_ids : iterable of ObjectId
+        Users to refresh, may be a lazy cursor
+    k : int
+        Candidates stored per user
+    batch_size : int
+        Users per batch
+    workers : int
+        Batches processed at the same time
+
+    Returns
+    -------
+    refreshed : int
+        Number of users whose recommendations were written
+    """
+    started = time.perf_counter()
+    app = current_app._get_current_object()
+
+    def refresh(batch):
+        # worker threads need their own app context for the read preferences
+        with app.app_context():
+            return _refresh_batch(batch, k)
+
+    refreshed = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        for batch in batched(user_ids, batch_size):
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                refreshed += sum(future.result() for future in done)
+            pending.add(pool.submit(refresh, batch))
+        refreshed += sum(future.result() for future in pending)
+
+    logger.info(
+        f"Refreshed recommendations for {refreshed} users"
+        f" in {time.perf_counter() - started:.1f}s"
+    )
+
+    return refreshed
+
+
+def refresh_all(**kwargs):
+    """Refresh recommendations for every user."""
+    cursor = mongo.db.users.find({}, {"_id": 1}, batch_size=10_000)
+    return refresh_recommendations((user["_id"] for user in cursor), **kwargs)
+
+
+def mark_dirty(*user_ids):
+    """
+    Flag users whose friendships changed.
+
+    Adding an edge changes the two-hop neighborhood of both users and of
+    everyone already friends with them, so :func:`refresh_dirty` recomputes
+    the flagged users together with their friends.
+    """
+    mongo.db.recommendations_dirty.bulk_write(
+        [
+            UpdateOne(
+                {"_id": user_id}, {"$currentDate": {"marked_at": True}}, upsert=True
+            )
+            for user_id in user_ids
+        ],
+        ordered=False,
+    )
+
+
+def refresh_dirty(marked_batch_size: int = 1000, **kwargs):
+    """
+    Refresh every user affected by friendships added since the last run.
+
+    Flagged users are read ``marked_batch_size`` at a time in ``_id`` order,
+    and each batch is refreshed and unflagged before the next is read, so a
+    large backlog never has to fit in memory. A friend shared by flagged
+    users in different batches may be refreshed more than once.
+    """
+    refreshed = 0
+    last_id = None
+    while True:
+        query = {} if last_id is None else {"_id": {"$gt": last_id}}
+        marked = list(
+            mongo.db.recommendations_dirty.find(query)
+            .sort("_id", 1)
+            .limit(marked_batch_size)
+        )
+        if not marked:
+            return refreshed
+        last_id = marked[-1]["_id"]
+
+        marked_ids = [doc["_id"] for doc in marked]
+        affected = set(marked_ids)
+        for friends in get_friend_lists(marked_ids).values():
+            affected.update(friends)
+
+        refreshed += refresh_recommendations(affected, **kwargs)
+
+        # users marked again while the refresh ran stay flagged for the next run
+        mongo.db.recommendations_dirty.bulk_write(
+            [
+                DeleteOne({"_id": doc["_id"], "marked_at": doc["marked_at"]})
+                for doc in marked
+            ],
+            ordered=False,
+        )
@@ -1,7 +1,17 @@
 from datetime import datetime, timedelta
 
+from bson import ObjectId
+from bson.errors import InvalidId
 from dateutil.parser import parse
 from flask_restx import ValidationError
+from werkzeug.exceptions import BadRequest
+
+# search budget argument -> config key holding the server's limit
+SEARCH_BUDGETS = {
+    "max_depth": "MAX_SEARCH_DEPTH",
+    "max_nodes": "MAX_SEARCH_NODES",
+    "deadline_ms": "SEARCH_DEADLINE_MS",
+}
 
 
 def parse_timestamp(timestamp: str):
@@ -54,3 +64,99 @@ def validate_timestamp_range(start_time: str, end_time: str, default_range: int
         raise ValidationError("start_time must be before end_time")
 
     return start_time, end_time
+
+
+def validate_page_args(limit: str, after: str, default_limit: int, max_limit: int):
+    """
+    Validate keyset pagination arguments.
+
+    Args:
+        limit (str): Requested page size, may be None.
+        after (str): Cursor returned with the previous page, may be None.
+        default_limit (int): Page size used when limit is None.
+        max_limit (int): Largest page size a client may request.
+
+    Returns:
+        tuple: The page size as an int and the cursor as an ObjectId (or None).
+
+    Raises:
+        BadRequest: If limit is not a positive integer or after is not a valid cursor.
+    """
+    if limit is None:
+        limit = default_limit
+    else:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise BadRequest("limit must be an integer")
+        if limit < 1:
+            raise BadRequest("limit must be positive")
+
+    if after is not None:
+        try:
+            after = ObjectId(after)
+        except (InvalidId, TypeError):
+            raise BadRequest("Invalid cursor")
+
+    return min(limit, max_limit), after
+
+
+def validate_batch_size(batch_size: str, default_size: int, max_size: int):
+    """
+    Validate the cursor batch size of a streamed listing.
+
+    Args:
+        batch_size (str): Requested documents per round trip, may be None.
+        default_size (int): Batch size used when batch_size is None.
+        max_size (int): Largest batch size a client may request.
+
+    Returns:
+        int: The batch size.
+
+    Raises:
+        BadRequest: If batch_size is not a positive integer.
+    """
+    if batch_size is None:
+        return default_size
+
+    try:
+        batch_size = int(batch_size)
+    except ValueError:
+        raise BadRequest("batch_size must be an integer")
+    if batch_size < 1:
+        raise BadRequest("batch_size must be positive")
+
+    return min(batch_size, max_size)
+
+
+def validate_search_budgets(requested: dict, config):
+    """
+    Combine the graph search budgets a client asked for with the server's.
+
+    Clients may tighten the server budgets but never loosen them.
+
+    Args:
+        requested (dict): Budgets by argument name as ints or query strings,
+            missing or None for the server's.
+        config (Config): App config holding the server's budgets.
+
+    Returns:
+        dict: max_depth, max_nodes and deadline_ms for the search functions.
+
+    Raises:
+        BadRequest: If a requested budget is not a positive integer.
+    """
+    budgets = {}
+    for arg, key in SEARCH_BUDGETS.items():
+        value = requested.get(arg)
+        if value is None:
+            budgets[arg] = config[key]
+            continue
+        try:
+            value = int(value)
+        except ValueError:
+            raise BadRequest(f"{arg} must be an integer")
+        if value < 1:
+            raise BadRequest(f"{arg} must be positive")
+        budgets[arg] = min(value, config[key])
+    return budgets
@@ -23,6 +23,15 @@
         "created_at": DateTime     // Timestamp
     }
 
+    friend_buckets collection (FRIEND_STORAGE=buckets, replaces user.friends):
+
+    {
+        "_id": ObjectId,
+        "user_id": ObjectId,       // owner of the bucket
+        "count": Number,           // entries in friends, at most FRIEND_BUCKET_SIZE
+        "friends": [ObjectId, ...]
+    }
+
 
 */
 
@@ -57,6 +66,10 @@ const users = Array.from({ length: 10 }, (_, i) => {
   
 db.users.insertMany(users);
 
-// Create an index on the friendship_hash field in the friends collection
-db.friends.createIndex({ "friendship_hash": 1 });
-
+// Indexes mirror netwerker/utils/indexes.py, which also syncs them on startup
+db.users.createIndex({ "uuid": 1 }, { name: "uuid_unique", unique: true });
+db.users.createIndex({ "email": 1 }, { name: "email_unique", unique: true });
+db.friends.createIndex({ "friendship_hash": 1 }, { name: "friendship_hash_unique", unique: true });
+db.friends.createIndex({ "created_at": 1 }, { name: "created_at" });
+db.friend_buckets.createIndex({ "user_id": 1, "count": 1 }, { name: "user_count" });
+db.friend_buckets.createIndex({ "user_id": 1, "_id": 1 }, { name: "user_buckets" });
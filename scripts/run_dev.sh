@@ -39,6 +39,10 @@ echo "Starting Docker containers..."
 docker-compose up -d
 check_success "Started Docker containers"
 
+echo "Syncing MongoDB indexes..."
+docker-compose exec -T web flask db sync-indexes
+check_success "Synced MongoDB indexes"
+
 echo "Starting NGINX..."
 sudo service nginx start
 check_success "Started NGINX"
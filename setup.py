@@ -20,4 +20,8 @@ setup(
         "Werkzeug",
         "marshmallow-sqlalchemy",
     ],
+    extras_require={
+        # async serving mode, see netwerker/asgi.py
+        "async": ["quart", "motor", "hypercorn"],
+    },
 )